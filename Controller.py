@@ -1,18 +1,235 @@
 import socket
+import argparse
+import json
+import selectors
 import time
+import heapq
+import itertools
+from collections import deque
 
-servers = []
-port = 8000
+from count_file import CountFileWriter
+
+servers = []  # "host" or "host:port" lines of machines_file
+machines_file = "machines.txt"
+port = 8000  # Server port of the machines.txt lines without one
+job = None  # Module path of the map/reduce job run by the servers (e.g. "jobs.ngram_count"), None runs the word count
+streaming_shuffle = False  # Runs SPLIT and SHUFFLE as one pipelined SPLIT_SHUFFLE phase
+output_mode = "shuffle2"  # Final sorted output: "shuffle2" on the servers, "merge" of sorted runs or "topk" on the controller
+top_k = 100  # Number of words kept by the "topk" output mode
+save_results = False  # Saves the merged word counts to output_file in the "merge" and "topk" modes
+output_format = "columnar"  # Format of output_file: "columnar" count file (see count_file.py) or "text" lines appended to it
+output_file = "word_count.wcf"
+range_partitioner = "quantile"  # SHUFFLE2 count ranges: "quantile" (equal words per server) or "width" (equal count intervals)
+pipeline = False  # Lets every server run the phases between two barriers without waiting for the others, forces the servers' persistent_mesh
+barriers = ["REDUCE"]  # Phases all servers finish before the next one starts in pipeline mode (REDUCE always is one)
+heartbeat_timeout = 10  # Seconds without any line, heartbeats included, after which a server is considered dead
+phase_timeout = None  # Seconds a server may take to answer a command before it is considered dead, None waits forever
+max_failures = 3  # Failed servers tolerated before the job is aborted
+reconnect_timeout = 30  # Seconds to wait for a server, restarting after a failed attempt, to accept the controller
+speculation = False  # Lets an idle server split the last SPLIT units of a straggler, only with the plain SPLIT phase
+speculation_lag = 0.5  # A server straggles when its share of merged SPLIT units is below this fraction of the median one
+speculation_min_remaining = 2.0  # Seconds of estimated SPLIT work a straggler must have left to get a backup
+metrics_file = "metrics.json"  # JSON report of the per-phase metrics sent by the servers, None disables it
+
+# Time category of each phase in the pipeline mode summary
+phase_categories = {
+    "SPLIT": "computation", "SPLIT_SHUFFLE": "computation", "SHUFFLE": "shuffle",
+    "SYNCHRONIZE": "shuffle", "GROUP": "computation", "REDUCE": "computation",
+    "RANGE": "controller communication", "SHUFFLE2": "shuffle", "SYNCHRONIZE2": "shuffle",
+    "GROUP2": "computation", "MERGE": "computation", "TOPK": "computation",
+}
+
+class ServerFailure(Exception):
+    # A server died or stopped answering, server is its index in servers
+    def __init__(self, server, reason):
+        super().__init__(f"server {server} failed: {reason}")
+        self.server = server
+        self.reason = reason
+
+class ServerReader:
+    # Receives the lines of every server socket as they arrive, whatever server
+    # the controller is currently waiting on, and keeps their arrival time.
+    # HEARTBEAT lines only prove that a server is alive and are dropped here, so
+    # are the PROGRESS lines sent instead during a speculative SPLIT once recorded.
+    def __init__(self, sockets):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = [bytearray() for _ in sockets]
+        self.scanned = [0] * len(sockets)  # bytes of each buffer already searched for a newline
+        self.lines = [deque() for _ in sockets]  # (arrival time, line) not read yet
+        self.last_seen = [time.time()] * len(sockets)  # arrival time of the last data of each server
+        self.closed = [False] * len(sockets)  # connection closed by the server
+        self.done = [False] * len(sockets)  # QUIT_OK received, the server may close its connection
+        self.metrics = [[] for _ in sockets]  # per-phase metrics of each server, in phase order
+        self.progress = [None] * len(sockets)  # (units done, units) of the last PROGRESS line of each server
+        for i, s in enumerate(sockets):
+            self.selector.register(s, selectors.EVENT_READ, i)
+        self.inputs = [ServerInput(self, i) for i in range(len(sockets))]
+
+    def pump(self, timeout=None):
+        # Moves every line received since the last call into self.lines
+        for key, _ in self.selector.select(timeout):
+            i = key.data
+            try:
+                data = key.fileobj.recv(65536)
+            except OSError:
+                data = b""
+            now = time.time()
+            self.last_seen[i] = now
+            if not data:
+                self.closed[i] = True
+                # Connection closed, readline() returns "" from now on
+                self.selector.unregister(key.fileobj)
+                self.lines[i].append((now, ""))
+                continue
+            buffer = self.buffers[i]
+            buffer += data
+            start = 0
+            while True:
+                # A long MERGE line arrives in many recv(), only its new bytes are searched
+                nl = buffer.find(b"\n", max(start, self.scanned[i]))
+                if nl == -1:
+                    self.scanned[i] = len(buffer) - start
+                    break
+                line = buffer[start:nl + 1].decode("utf-8")
+                start = nl + 1
+                if line == "HEARTBEAT\n":
+                    continue
+                if line.startswith("PROGRESS;"):
+                    done, total = line.split(";")[1:]
+                    self.progress[i] = (int(done), int(total))
+                    continue
+                response, tab, phase_metrics = line.rstrip("\n").partition("\t")
+                if tab and response.split(";")[0].endswith("_OK"):
+                    # "<PHASE>_OK[;...]\t{metrics}", the rest of the controller only sees the response
+                    self.metrics[i].append(json.loads(phase_metrics))
+                    line = response + "\n"
+                if line.startswith("QUIT_OK"):
+                    self.done[i] = True
+                self.lines[i].append((now, line))
+            del buffer[:start]
+
+    def readline(self, i):
+        started = time.time()
+        while not self.lines[i]:
+            self.pump(1.0)
+            self.check(i, started)
+        arrival, line = self.lines[i][0]
+        if not line:
+            raise ServerFailure(i, "connection closed")
+        self.lines[i].popleft()
+        return arrival, line
+
+    def check(self, waiting, started):
+        # Raises ServerFailure for any dead server, not only the one the controller
+        # waits on, since the others may be blocked waiting for the dead one
+        now = time.time()
+        for i in range(len(self.lines)):
+            if self.done[i]:
+                continue
+            if self.closed[i]:
+                raise ServerFailure(i, "connection closed")
+            if now - self.last_seen[i] > heartbeat_timeout:
+                raise ServerFailure(i, f"no heartbeat for {int(now - self.last_seen[i])} s")
+        if phase_timeout is not None and now - started > phase_timeout:
+            raise ServerFailure(waiting, f"no answer for {int(now - started)} s")
+
+    def close(self):
+        self.selector.close()
+
+class ServerInput:
+    # File-like view of the lines of one server
+    def __init__(self, reader, i):
+        self.reader = reader
+        self.i = i
+        self.last_time = None  # arrival time of the last line read
+
+    def readline(self):
+        self.last_time, line = self.reader.readline(self.i)
+        return line
+
+    def close(self):
+        pass
+
+class ServerOutput:
+    # Command stream to one server, a failed write means that server is gone
+    def __init__(self, sock, i):
+        self.file = sock.makefile('w')
+        self.i = i
+
+    def write(self, data):
+        try:
+            self.file.write(data)
+        except OSError as e:
+            raise ServerFailure(self.i, str(e))
+
+    def flush(self):
+        try:
+            self.file.flush()
+        except OSError as e:
+            raise ServerFailure(self.i, str(e))
+
+    def close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
 
 def read_machine(filename):
     with open(filename, 'r') as f:
         return [line.strip() for line in f.readlines() if line.strip()]
 
+def partition_owners(machines_num, alive):
+    # Input slice and hash partition p belong to machine p, or to the next alive
+    # machine after it when it failed, so a failure only moves the failed work.
+    # Returns the index in alive of the owner of each partition.
+    owners = []
+    for p in range(machines_num):
+        k = p
+        while k not in alive:
+            k = (k + 1) % machines_num
+        owners.append(alive.index(k))
+    return owners
+
+def parse_address(server):
+    # "host" or "host:port", several servers may share a host on distinct ports
+    host, _, server_port = server.partition(":")
+    return host, int(server_port) if server_port else port
+
+def connect_with_retry(server):
+    # A server restarting after a failed attempt may not be listening yet
+    deadline = time.time() + reconnect_timeout
+    while True:
+        try:
+            return socket.create_connection(parse_address(server))
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
 def main():
     global servers
 
-    servers = read_machine("machines.txt")
+    machines = read_machine(machines_file)
+    alive = list(range(len(machines)))  # indexes in machines of the servers still running
+    failures = 0
 
+    while True:
+        servers = [machines[k] for k in alive]
+        try:
+            run_job(partition_owners(len(machines), alive))
+            return
+        except ServerFailure as e:
+            failures += 1
+            print(f"Server {servers[e.server]} failed: {e.reason}")
+            if failures > max_failures or len(alive) == 1:
+                print("Too many failed servers, aborting the job.")
+                return
+            del alive[e.server]
+            print(f"Re-executing the job on {len(alive)} servers, the slices and partitions "
+                  f"of {servers[e.server]} go to the next alive server.")
+
+def run_job(owners):
+    # Runs the whole job once on servers, raises ServerFailure if one of them fails
     shuffle_time = 0
     computation_time = 0
     controller_communication_time = 0
@@ -20,20 +237,35 @@ def main():
     start, local_start = time.time(), time.time()
 
     client_sockets, outputs, inputs = [], [], []
-    for server in servers:
-        s = socket.create_connection((server, port))
+    for i, server in enumerate(servers):
+        try:
+            s = connect_with_retry(server)
+        except OSError as e:
+            for s in client_sockets:
+                s.close()
+            raise ServerFailure(i, str(e))
         client_sockets.append(s)
-        outputs.append(s.makefile('w'))
-        inputs.append(s.makefile('r'))
+        outputs.append(ServerOutput(s, i))
+    reader = ServerReader(client_sockets)
+    inputs = reader.inputs
 
     try:
         for i, out in enumerate(outputs):
             msg = ""
             for idx, server in enumerate(servers):
-                msg += f"{idx} {server}"
+                host, server_port = parse_address(server)
+                msg += f"{idx} {host}:{server_port}"
                 msg += " 1" if idx == i else " 0"
                 if idx != len(servers) - 1:
                     msg += ";"
+            if job:
+                msg += f";job {job}"
+            if owners != list(range(len(servers))):
+                msg += f";owners {','.join(map(str, owners))}"
+            if pipeline:
+                msg += ";pipeline 1"
+            if speculation and not (streaming_shuffle or pipeline):
+                msg += ";speculation 1"
             out.write(msg + "\n")
             out.flush()
 
@@ -44,28 +276,60 @@ def main():
 
         start, local_start = time.time(), time.time()
 
+        if pipeline:
+            times = run_pipeline(outputs, inputs)
+            save_metrics(reader.metrics)
+            print_summary(times["shuffle"] + shuffle_time, times["computation"] + computation_time,
+                          times["controller communication"] + controller_communication_time)
+            for s, o, i in zip(client_sockets, outputs, inputs):
+                o.close()
+                i.close()
+                s.close()
+            reader.close()
+            return
+
         for out in outputs:
-            out.write("SPLIT\n")
+            out.write("SPLIT_SHUFFLE\n" if streaming_shuffle else "SPLIT\n")
             out.flush()
 
+        # The speculative SPLIT reads the SPLIT_OK responses itself
+        pending = run_speculative_split(reader, outputs) if speculation and not streaming_shuffle else None
         responses = [""] * len(servers)
         while True:
-            for i, inp in enumerate(inputs):
-                responses[i] = inp.readline().strip()
+            if pending:
+                responses, pending = pending, None
+            else:
+                for i, inp in enumerate(inputs):
+                    responses[i] = inp.readline().strip()
             response = check_responses(responses)
+            if response not in ("NO_RESPONSE", "END"):
+                print_stragglers(response[:-len("_END")], [(inp.last_time - local_start) * 1000 for inp in inputs])
 
             if response == "SPLIT_END":
                 end, local_end = time.time(), time.time()
                 computation_time += (end - start) * 1000
                 print(f"Time for SPLIT: {int((local_end - local_start) * 1000)} ms.")
+                print_split_cache(reader.metrics)
                 start, local_start = time.time(), time.time()
                 for out in outputs:
                     out.write("SHUFFLE\n")
                     out.flush()
 
+            elif response == "SPLIT_SHUFFLE_END":
+                end, local_end = time.time(), time.time()
+                computation_time += (end - start) * 1000
+                print(f"Time for SPLIT_SHUFFLE: {int((local_end - local_start) * 1000)} ms.")
+                print_split_cache(reader.metrics)
+                print_bytes_on_wire("SPLIT_SHUFFLE", responses)
+                start, local_start = time.time(), time.time()
+                for out in outputs:
+                    out.write("SYNCHRONIZE\n")
+                    out.flush()
+
             elif response == "SHUFFLE_END":
                 local_end = time.time()
                 print(f"Time for SHUFFLE: {int((local_end - local_start) * 1000)} ms.")
+                print_bytes_on_wire("SHUFFLE", responses)
                 local_start = time.time()
                 for out in outputs:
                     out.write("SYNCHRONIZE\n")
@@ -94,38 +358,33 @@ def main():
                 print(f"Time for REDUCE: {int((local_end - local_start) * 1000)} ms.")
                 start, local_start = time.time(), time.time()
 
-                responses = [inp.readline().strip() for inp in inputs]
-                max_val, min_val = -float('inf'), float('inf')
-                for resp in responses:
-                    res = resp.split(";")
-                    if res[0] == "0": continue
-                    max_val, min_val = max(max_val, int(res[0])), min(min_val, int(res[1]))
-                range_val = round((max_val - min_val + 1) / len(servers))
-                global_min, msg = min_val, ""
-                for i in range(len(servers) - 1):
-                    min_val = max_val - range_val + 1
-                    if min_val <= global_min or max_val <= global_min:
-                        msg += f"{i},0,0;"
-                        continue
-                    msg += f"{i},{max_val},{min_val};"
-                    max_val = min_val - 1
-                msg += f"{len(servers)-1},{max_val},{global_min};"
-                for out in outputs:
-                    out.write(msg + "\n")
-                    out.flush()
+                send_ranges([inp.readline().strip() for inp in inputs], outputs)
 
             elif response == "RANGE_END":
                 end, local_end = time.time(), time.time()
                 controller_communication_time += (end - start) * 1000
                 print(f"Time for RANGE: {int((local_end - local_start) * 1000)} ms.")
                 start, local_start = time.time(), time.time()
+                if output_mode == "shuffle2":
+                    for out in outputs:
+                        out.write("SHUFFLE2\n")
+                        out.flush()
+                    continue
+
+                # Sorted runs are merged here, SHUFFLE2, SYNCHRONIZE2 and GROUP2 are skipped
+                phase = run_merge(outputs, inputs)
+                end, local_end = time.time(), time.time()
+                computation_time += (end - start) * 1000
+                print(f"Time for {phase}: {int((local_end - local_start) * 1000)} ms.")
                 for out in outputs:
-                    out.write("SHUFFLE2\n")
+                    out.write("QUIT\n")
                     out.flush()
+                    time.sleep(0.05)
 
             elif response == "SHUFFLE2_END":
                 local_end = time.time()
                 print(f"Time for SHUFFLE2: {int((local_end - local_start) * 1000)} ms.")
+                print_bytes_on_wire("SHUFFLE2", responses)
                 local_start = time.time()
                 for out in outputs:
                     out.write("SYNCHRONIZE2\n")
@@ -150,23 +409,384 @@ def main():
                     time.sleep(0.05)
 
             elif response == "END":
-                print("All processes are done.")
-                print(f"Time for shuffle: {int(shuffle_time)} ms.")
-                print(f"Time for computation: {int(computation_time)} ms.")
-                print(f"Time for controller communication: {int(controller_communication_time)} ms.")
-                print(f"Time total: {int(shuffle_time + computation_time + controller_communication_time)} ms.")
+                save_metrics(reader.metrics)
+                print_summary(shuffle_time, computation_time, controller_communication_time)
                 break
 
         for s, o, i in zip(client_sockets, outputs, inputs):
             o.close()
             i.close()
             s.close()
+        reader.close()
 
+    except ServerFailure as e:
+        # Survivors notice the closed connection and restart for the next attempt
+        for s in client_sockets:
+            s.close()
+        reader.close()
+        if any(reader.done):
+            # Servers that answered QUIT saved their results and are gone, no attempt can follow
+            print(f"Server {servers[e.server]} failed during QUIT: {e.reason}, its results are lost.")
+            return
+        raise
     except Exception as e:
         print(f"Error: {e}")
 
+def print_summary(shuffle_time, computation_time, controller_communication_time):
+    print("All processes are done.")
+    print(f"Time for shuffle: {int(shuffle_time)} ms.")
+    print(f"Time for computation: {int(computation_time)} ms.")
+    print(f"Time for controller communication: {int(controller_communication_time)} ms.")
+    print(f"Time total: {int(shuffle_time + computation_time + controller_communication_time)} ms.")
+
+def save_metrics(server_metrics):
+    # Writes {"servers": [...], "phases": [{"phase", "total", "servers": [metrics of each server]}]}
+    if not metrics_file:
+        return
+    phases = []
+    for entries in zip(*server_metrics):
+        total = {
+            "max_wall_ms": max(m["wall_ms"] for m in entries),
+            "cpu_ms": round(sum(m["cpu_ms"] + m["children_cpu_ms"] for m in entries), 1),
+            "max_peak_rss_mb": max(m["peak_rss_mb"] for m in entries),
+            "tokens": sum(m.get("tokens", 0) for m in entries),
+            "bytes_sent": sum(sum(m.get("bytes_sent", {}).values()) for m in entries),
+        }
+        phases.append({"phase": entries[0]["phase"], "total": total, "servers": list(entries)})
+    with open(metrics_file, "w") as f:
+        json.dump({"servers": servers, "phases": phases}, f, indent=1)
+    print(f"Per-phase metrics of the servers saved to {metrics_file}")
+
+def pipeline_stages():
+    # Phases of the job cut after every barrier. The range exchange inside REDUCE
+    # needs every server's histogram, so REDUCE always ends a stage.
+    phases = ["SPLIT_SHUFFLE"] if streaming_shuffle else ["SPLIT", "SHUFFLE"]
+    phases += ["SYNCHRONIZE", "GROUP", "REDUCE"]
+    if output_mode == "shuffle2":
+        phases += ["SHUFFLE2", "SYNCHRONIZE2", "GROUP2"]
+    stages, stage = [], []
+    for phase in phases:
+        stage.append(phase)
+        if phase in barriers or phase == "REDUCE":
+            stages.append(stage)
+            stage = []
+    if stage:
+        stages.append(stage)
+    return stages
+
+def run_pipeline(outputs, inputs):
+    # Sends each stage as one "PIPELINE;PHASE,PHASE,..." command, so servers go
+    # through its phases at their own pace. A phase ends when the last server
+    # reports it, and its time is measured from the end of the previous phase.
+    # Returns the time spent per phase category in ms.
+    times = {"shuffle": 0, "computation": 0, "controller communication": 0}
+    previous = time.time()
+    last_done = [previous] * len(inputs)  # when each server finished its previous phase
+
+    def phase_done(phase):
+        nonlocal previous
+        finish = max(inp.last_time for inp in inputs)
+        elapsed = (finish - previous) * 1000
+        times[phase_categories[phase]] += elapsed
+        print_stragglers(phase, [(inp.last_time - done) * 1000 for inp, done in zip(inputs, last_done)])
+        print(f"Time for {phase}: {int(elapsed)} ms.")
+        previous = finish
+        last_done[:] = [inp.last_time for inp in inputs]
+
+    for stage in pipeline_stages():
+        for out in outputs:
+            out.write("PIPELINE;" + ",".join(stage) + "\n")
+            out.flush()
+
+        histograms = []
+        for phase in stage:
+            responses = []
+            for inp in inputs:
+                responses.append(inp.readline().strip())
+            phase_done(phase)
+            if phase == "REDUCE":
+                histograms = [inp.readline().strip() for inp in inputs]
+            if phase in ("SPLIT", "SPLIT_SHUFFLE"):
+                print_split_cache(inputs[0].reader.metrics)
+            if phase in ("SPLIT_SHUFFLE", "SHUFFLE", "SHUFFLE2"):
+                print_bytes_on_wire(phase, responses)
+
+        if histograms:
+            last_done[:] = [time.time()] * len(inputs)
+            send_ranges(histograms, outputs)
+            for inp in inputs:
+                inp.readline()
+            phase_done("RANGE")
+
+    if output_mode != "shuffle2":
+        last_done[:] = [time.time()] * len(inputs)
+        phase = run_merge(outputs, inputs)
+        phase_done(phase)
+
+    for out in outputs:
+        out.write("QUIT\n")
+        out.flush()
+    for inp in inputs:
+        inp.readline()
+    return times
+
+def run_speculative_split(reader, outputs):
+    # Waits for the SPLIT_OK of every server. When a server lags behind the others, an
+    # idle one splits its units from the last one backwards with SPECULATE;v;k, k being
+    # the first unit v had not merged yet. Both are stopped once their units meet, v
+    # keeps its first m merged units (SPLIT_OK;m) and the backup merges the rest after
+    # SPECULATE_COMMIT;m, answering SPECULATE_COMMIT_OK;tokens. Returns the SPLIT_OK responses.
+    n = len(outputs)
+    responses = [None] * n
+    arrivals = [None] * n
+    backups = {}  # {straggler: speculation state}
+    started = time.time()
+
+    def send(i, command):
+        outputs[i].write(command + "\n")
+        outputs[i].flush()
+
+    def stop(v):
+        backup = backups[v]
+        if not backup["stopped"]:
+            backup["stopped"] = True
+            if responses[v] is None:
+                send(v, "SPLIT_STOP")
+            if backup["lowest"] is None:
+                send(backup["server"], "SPECULATE_STOP")
+
+    def straggler_of(b):
+        return next(v for v, backup in backups.items() if backup["server"] == b)
+
+    while any(r is None for r in responses) or backups:
+        reader.pump(1.0)
+        for i in range(n):
+            while reader.lines[i]:
+                arrival, line = reader.readline(i)
+                line = line.strip()
+                if line.startswith("SPLIT_OK"):
+                    responses[i], arrivals[i] = line, arrival
+                    if i in backups:
+                        stop(i)
+                elif line.startswith("SPECULATE_OK;"):
+                    v = straggler_of(i)
+                    backups[v]["lowest"] = int(line.split(";")[1])
+                    stop(v)
+                elif line.startswith("SPECULATE_COMMIT_OK;"):
+                    del backups[straggler_of(i)]
+                    add_speculated_tokens(reader.metrics[i], int(line.split(";")[1]))
+
+        for v, backup in backups.items():
+            b, units = backup["server"], backup["units"]
+            if backup["stopped"] and not backup["committed"] and responses[v] is not None and backup["lowest"] is not None:
+                merged = int(responses[v].split(";")[1])
+                print(f"Server {v} kept SPLIT units 0 to {merged - 1} of {units}, "
+                      f"server {b} the {units - merged} after them.")
+                send(b, f"SPECULATE_COMMIT;{merged}")
+                backup["committed"] = True
+            elif not backup["stopped"] and reader.progress[v] and reader.progress[b]:
+                # The straggler merged the units [0, done), the backup the last ones
+                if reader.progress[v][0] + reader.progress[b][0] >= units:
+                    stop(v)
+
+        # Backups for the stragglers, from the idle servers done with their own units
+        busy = set(backups) | {backup["server"] for backup in backups.values()}
+        idle = [i for i in range(n) if responses[i] is not None and i not in busy]
+        shares = sorted(1.0 if responses[i] is not None else
+                        reader.progress[i][0] / reader.progress[i][1] if reader.progress[i] else 0.0
+                        for i in range(n))
+        elapsed = time.time() - started
+        for v in range(n):
+            if not idle or responses[v] is not None or v in busy or not reader.progress[v]:
+                continue
+            done, units = reader.progress[v]
+            if done >= units or done / units >= speculation_lag * shares[n // 2]:
+                continue
+            remaining = (units - done) * elapsed / done if done else float("inf")
+            if remaining < speculation_min_remaining:
+                continue
+            b = idle.pop(0)
+            print(f"Speculating on server {v} ({done} of {units} SPLIT units merged), "
+                  f"server {b} splits units {done} to {units - 1} backwards.")
+            reader.progress[b] = None
+            backups[v] = {"server": b, "units": units, "lowest": None, "stopped": False, "committed": False}
+            send(b, f"SPECULATE;{v};{done}")
+
+        missing = [i for i in range(n) if responses[i] is None]
+        reader.check(missing[0] if missing else 0, started)
+
+    # SPLIT times of print_stragglers, the SPECULATE lines came after
+    for i, arrival in enumerate(arrivals):
+        reader.inputs[i].last_time = arrival
+    return responses
+
+def add_speculated_tokens(phases, tokens):
+    # The units merged by a backup count in its SPLIT metrics, reported before them
+    split = next((m for m in phases if m["phase"] == "SPLIT"), None)
+    if split is not None:
+        split["tokens"] = split.get("tokens", 0) + tokens
+        split["speculated_tokens"] = split.get("speculated_tokens", 0) + tokens
+
+def print_stragglers(phase, durations):
+    # Per-server times of a phase, durations in ms
+    ordered = sorted(durations)
+    median = ordered[len(ordered) // 2] if len(ordered) % 2 else (ordered[len(ordered) // 2 - 1] + ordered[len(ordered) // 2]) / 2
+    slowest = durations.index(ordered[-1])
+    print(f"Straggler stats for {phase}: min {int(ordered[0])} ms, median {int(median)} ms, "
+          f"max {int(ordered[-1])} ms (server {slowest})")
+
+def send_ranges(responses, outputs):
+    # Each server sends "max;min;count:words,count:words,...", every server gets back
+    # the SHUFFLE2 count range of each server as "idx,max,min;..."
+    max_val, min_val = -float('inf'), float('inf')
+    histogram = {}  # {count: number of words}
+    for resp in responses:
+        res = resp.split(";")
+        if res[0] == "0": continue
+        max_val, min_val = max(max_val, int(res[0])), min(min_val, int(res[1]))
+        for entry in res[2].split(","):
+            count, words = entry.split(":")
+            histogram[int(count)] = histogram.get(int(count), 0) + int(words)
+    if not histogram:
+        server_ranges = [(0, 0)] * len(servers)
+    elif range_partitioner == "quantile":
+        server_ranges = quantile_ranges(histogram, len(servers))
+    else:
+        server_ranges = width_ranges(max_val, min_val, len(servers))
+    print_range_skew(histogram, server_ranges)
+    msg = "".join(f"{i},{hi},{lo};" for i, (hi, lo) in enumerate(server_ranges))
+    for out in outputs:
+        out.write(msg + "\n")
+        out.flush()
+
+def run_merge(outputs, inputs):
+    # Runs the MERGE or TOPK output mode and returns the phase name
+    phase = "MERGE" if output_mode == "merge" else "TOPK"
+    for out in outputs:
+        out.write("MERGE\n" if output_mode == "merge" else f"TOPK;{top_k}\n")
+        out.flush()
+    merge_sorted_runs(inputs, f"{phase}_OK", top_k if output_mode == "topk" else None)
+    return phase
+
+def read_sorted_run(inp, marker):
+    # Yields the (count, words) lines sent by one server until its end marker
+    while True:
+        line = inp.readline().rstrip("\n")
+        if not line or line == marker:
+            return
+        # Tab separated, a word may hold a ";"
+        count, _, words = line.partition("\t")
+        yield int(count), words.split("\t")
+
+def merge_sorted_runs(inputs, marker, top_k=None):
+    # Streaming k-way merge of the servers' runs sorted by decreasing count
+    runs = [read_sorted_run(inp, marker) for inp in inputs]
+    merged = heapq.merge(*runs, key=lambda run: -run[0])
+    f = writer = None
+    if save_results and output_format == "columnar":
+        writer = CountFileWriter(output_file)
+    elif save_results:
+        f = open(output_file, "a")
+    kept = f.tell() if f else 0
+    total = 0
+    try:
+        for count, group in itertools.groupby(merged, key=lambda run: run[0]):
+            words = [word for _, run_words in group for word in run_words]
+            if top_k is not None:
+                words = words[:top_k - total]
+            total += len(words)
+            if writer:
+                writer.write(count, words)
+            if f:
+                f.write(f"{count}: {', '.join(words)}\n")
+            if top_k is not None and total >= top_k:
+                break
+        # Read what is left up to every end marker
+        for _ in merged:
+            pass
+    except ServerFailure:
+        # The next attempt writes the whole output again
+        if writer:
+            writer.abort()
+            writer = None
+        if f:
+            f.truncate(kept)
+        raise
+    finally:
+        if writer:
+            writer.close()
+        if f:
+            f.close()
+
+def width_ranges(max_val, min_val, n):
+    # Splits [min_val, max_val] in n equal count intervals, highest counts first. (0, 0) is an empty range.
+    range_val = round((max_val - min_val + 1) / n)
+    global_min, server_ranges = min_val, []
+    for i in range(n - 1):
+        min_val = max_val - range_val + 1
+        if min_val <= global_min or max_val <= global_min:
+            server_ranges.append((0, 0))
+            continue
+        server_ranges.append((max_val, min_val))
+        max_val = min_val - 1
+    server_ranges.append((max_val, global_min))
+    return server_ranges
+
+def quantile_ranges(histogram, n):
+    # Splits the counts in n contiguous ranges holding about the same number of words,
+    # highest counts first. A single count cannot be split, so some ranges may stay empty (0, 0).
+    counts = sorted(histogram, reverse=True)
+    remaining = sum(histogram.values())
+    server_ranges, i = [], 0
+    for server in range(n):
+        if i == len(counts):
+            server_ranges.append((0, 0))
+            continue
+        target = remaining / (n - server)
+        hi, words = counts[i], 0
+        # Takes the next count while that brings the range closer to the target
+        while i < len(counts) and (words == 0 or words + histogram[counts[i]] / 2 <= target or server == n - 1):
+            words += histogram[counts[i]]
+            i += 1
+        server_ranges.append((hi, counts[i - 1]))
+        remaining -= words
+    return server_ranges
+
+def print_range_skew(histogram, server_ranges):
+    words = [sum(w for c, w in histogram.items() if lo <= c <= hi) if hi > 0 else 0 for hi, lo in server_ranges]
+    mean = sum(words) / len(words)
+    skew = max(words) / mean if mean else 1
+    print(f"Words per server for SHUFFLE2: {words}, max/mean skew {skew:.2f}")
+
+def print_bytes_on_wire(phase, responses):
+    # Shuffle responses look like "<PHASE>_OK;peer,raw_bytes,wire_bytes;..."
+    for i, resp in enumerate(responses):
+        total_raw, total_wire, peers = 0, 0, []
+        for token in resp.split(";")[1:]:
+            if token == "":
+                continue
+            peer, raw, wire = (int(x) for x in token.split(","))
+            total_raw, total_wire = total_raw + raw, total_wire + wire
+            peers.append(f"to {peer}: {wire} bytes x{raw / wire if wire else 1:.2f}")
+        ratio = total_raw / total_wire if total_wire else 1
+        print(f"Bytes on wire for {phase} from server {i}: {total_wire} bytes, compression ratio {ratio:.2f} ({', '.join(peers)})")
+
+def print_split_cache(server_metrics):
+    # Incremental SPLIT servers report the cached blocks of each input file they read
+    for i, phases in enumerate(server_metrics):
+        # In pipeline mode a server may already have reported the phases after SPLIT
+        split = next((m for m in phases if m["phase"] in ("SPLIT", "SPLIT_SHUFFLE")), None)
+        cache = split.get("split_cache") if split else None
+        if cache is None:
+            continue
+        for file_path, stats in sorted(cache.items()):
+            status = "hit" if not stats["misses"] else "miss" if not stats["hits"] else "partial hit"
+            print(f"Split cache {status} on server {i} for {file_path} "
+                  f"({stats['hits']} cached and {stats['misses']} mapped blocks)")
+
 def check_responses(responses):
     # Checks the responses from all servers and returns the appropriate end signal
+    if all("SPLIT_SHUFFLE_OK" in r for r in responses): return "SPLIT_SHUFFLE_END"
     if all("SPLIT_OK" in r for r in responses): return "SPLIT_END"
     if all("SHUFFLE_OK" in r for r in responses): return "SHUFFLE_END"
     if all("SYNCHRONIZE_OK" in r for r in responses): return "SYNCHRONIZE_END"
@@ -180,4 +800,10 @@ def check_responses(responses):
     return "NO_RESPONSE"
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MapReduce controller")
+    parser.add_argument("--machines", default=machines_file, help="file listing one host or host:port per server")
+    parser.add_argument("--port", type=int, default=port, help="server port of the machines without one")
+    args = parser.parse_args()
+    machines_file = args.machines
+    port = args.port
     main()
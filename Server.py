@@ -4,17 +4,90 @@ import os
 import time
 import threading
 import hashlib
+import zlib
+import bisect
+import multiprocessing
+import mmap
+import struct
+import importlib
+import selectors
+import select
+import lzma
+import heapq
+import itertools
+import tempfile
+import argparse
+import json
+import resource
+import cProfile
+import tracemalloc
+from array import array
+from collections import Counter
+
+from count_file import CountFileWriter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # ======= Global configuration =======
 save_results = False  # Saves the final word counts to a file
+use_combiner = True  # Pre-aggregates word counts per partition during SPLIT
+partitioner = "crc32"  # Hash used to assign words to servers, see partitioners
+partition_cache_size = 1000000  # Max number of distinct words whose server_id is memoized during SPLIT
+split_workers = os.cpu_count() or 1  # Local processes splitting this server's byte range
+use_mmap = True  # Tokenizes the input as raw bytes over an mmap instead of decoding line by line
+mmap_chunk_size = 16 * 1024 * 1024  # Bytes tokenized at once by the mmap reader
+stream_chunk_size = 32 * 1024 * 1024  # Bytes per split task in the pipelined SPLIT_SHUFFLE
+shuffle_batch_size = 100000  # Words buffered per peer before a batch is sent in SPLIT_SHUFFLE
+wire_protocol = "binary"  # Peer shuffle traffic format: "binary" frames or "text" lines
+frame_size = 1024 * 1024  # Payload bytes after which a binary frame is sent
+frame_compression = None  # Per-frame compression of binary frames: None, "zlib", "lzma" or "adaptive"
+compression_level = 6  # Level passed to the frame compression codec
+adaptive_codec = "zlib"  # Codec tried by the "adaptive" frame compression
+adaptive_sample_frames = 4  # Frames per peer sampled before "adaptive" keeps or drops compression
+link_bandwidth_mbps = 1000  # Assumed peer link speed used to decide if compression pays off
+shuffle_server = "threads"  # Inbound shuffle endpoint: "threads" (one port and Listener per peer) or "selectors" (one port)
+recv_size = 256 * 1024  # Bytes read per recv() by the selectors shuffle server
+persistent_mesh = True  # Connects to the peers once and reuses the connections for every shuffle round, forced by the controller's pipeline mode
+connect_retries = 10  # Attempts to connect to a peer that is not listening yet
+connect_backoff = 0.05  # Seconds before the first retry, doubled after every attempt
+connect_backoff_max = 2.0  # Max seconds between two connection attempts
+select_timeout = 1.0  # Seconds the selectors shuffle server waits before checking if it was closed
+memory_budget_words = None  # Words held per dict before it is spilled as a sorted run to disk, None keeps everything in memory
+spill_folder = None  # Folder of the spilled runs, None uses the system temp folder
+use_numpy = True  # Vectorizes REDUCE and the SHUFFLE2 routing of in-memory counts when NumPy is installed
+intern_words = False  # Dictionary encodes SHUFFLE: each word goes once per round to a peer, then only its ID, and received counts live in arrays indexed by ID
+speculation_unit_size = 32 * 1024 * 1024  # Input bytes per SPLIT unit when the controller enables speculation, a backup server takes over whole units
+split_cache_folder = None  # Folder caching the SPLIT partials of every input block so that re-runs only map new or changed files, None disables it
+split_block_size = 64 * 1024 * 1024  # Input bytes per cached SPLIT block
+heartbeat_interval = 1.0  # Seconds between two HEARTBEAT lines sent to the controller
+restart_on_abort = True  # Restarts the server, ready for the next attempt, when the controller drops the job
+restart_timeout = 60  # Seconds a restarted server waits for the controller before exiting, the job may have been aborted
+send_metrics = True  # Appends the phase metrics as JSON after a tab to every *_OK response
+profile_phases = False  # Dumps a cProfile of the main thread of every phase to profile_folder
+trace_memory = False  # Adds the tracemalloc peak of every phase to its metrics, slows the phases down
+profile_folder = "profiles"
 
 # ======= Server configuration =======
 server_port = 8000
+bind_address = ""  # Address the controller and shuffle listeners bind to, "" for every interface
 dataset_directory = "dataset"
+results_format = "columnar"  # Format of results_file: "columnar" count file (see count_file.py) or "text" lines appended to it
+results_file = "word_count_{id}.wcf"  # File the final counts are saved to with save_results, {id} is the server ID
 
 # ======= Shared variables =======
 id = None # ID of this server
 servers_num = None # Total number of servers
+owners = [] # server_id owning each input slice and hash partition, a failed server's ones are reassigned by the controller
+quitting = False # Set once QUIT was received, the controller connection may then close
+restarted = False # Set in a server re-executed by restart(), which only waits restart_timeout for the controller
+metrics = None # PhaseMetrics of the running phase
+job_module = None # Module path of the map/reduce job sent by the controller, None runs the built-in word count
+job = None # Loaded job module, see load_job()
+speculation = False # Set by the controller: SPLIT runs in units and reports its progress so that a backup can take over
+split_progress = None # (units done, units) of the running SPLIT or SPECULATE, sent with the heartbeats
 
 # ======= Communication with the controller =======
 server_socket = None
@@ -28,92 +101,661 @@ peer_outputs = None
 
 # ======= Shared dicts =======
 servers = {} # {server_id: server_address} dict
-words_per_server = {} # {server_id: [words]} dict
+server_ports = {} # {server_id: controller port}, its peer ports follow it
+words_per_server = {} # {server_id: [words]} dict, or {server_id: {word: count}} with the combiner
 ranges = {} # {server_id: (max, min)} dict
-word_count_list = {} # {word: [counts]} dict
+range_mins = [] # sorted min count of the non-empty ranges
+range_ids = [] # server_id owning each range_mins entry
+word_count_list = {} # {word: count} dict, or a WordTable with intern_words
 count_word_list = {} # {count: [words]} dict
 final_count_word_list = {} # {count: [words]} dict
+word_count_runs = None # SpillRuns of word_count_list, see init_spill_runs()
+count_word_runs = None # SpillRuns of count_word_list
+final_count_word_runs = None # SpillRuns of final_count_word_list
 
 
-def split():
-    global words_per_server
-    print(f"Started SPLIT on server {id}.")
+# ======= Partitioners =======
+# Each maps a word to a 32-bit integer that must be identical on every machine,
+# so Python's randomized built-in hash() cannot be used here.
+def sha256_hash(word):
+    return int(hashlib.sha256(word.encode()).hexdigest()[:8], 16)
 
-    files = os.listdir(dataset_directory)
+def blake2b_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), 'big')
 
-    line_num = 0
+def crc32_hash(word):
+    return zlib.crc32(word.encode())
 
-    for fname in files:
+partitioners = {
+    "sha256": sha256_hash,
+    "blake2b": blake2b_hash,
+    "crc32": crc32_hash,
+}
+
+
+def list_input_files():
+    # Sorted so that every server sees the same concatenated byte stream
+    files = []
+    for fname in sorted(os.listdir(dataset_directory)):
         file_path = os.path.join(dataset_directory, fname)
         if os.path.isfile(file_path) and ".wet" in fname:
-            print(f"Splitting file: {fname}")
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        if line_num % servers_num == id:
-                            tokens = line.strip().split()
-                            for token in tokens:
-                                server_id = int(hashlib.sha256(token.encode()).hexdigest()[:8], 16) % servers_num
-                                words_per_server.setdefault(server_id, []).append(token)
-                        line_num += 1
-            except Exception as e:
-                print(f"ERROR building words_per_server: {e}")
+            files.append((file_path, os.path.getsize(file_path)))
+    return files
+
+
+def byte_range_segments(files, start, end):
+    # Returns the (file_path, file_start, file_end) pieces of the byte range [start, end)
+    # of the concatenation of all input files
+    segments = []
+    offset = 0
+    for file_path, size in files:
+        seg_start, seg_end = max(start, offset), min(end, offset + size)
+        if seg_start < seg_end:
+            segments.append((file_path, seg_start - offset, seg_end - offset))
+        offset += size
+    return segments
+
+
+def split_range(args):
+    # Partitions the lines that start inside the given segments. A line belongs to the
+    # range holding its first byte, so adjacent ranges never count a line twice.
+    segments, owners, partitioner, use_combiner, partition_cache_size, _ = args
+
+    partition_hash = partitioners[partitioner]
+    partitions_num = len(owners)
+    partition_cache = {} # {word: server_id} bounded memo
+    partial = {} # same layout as words_per_server
+
+    for file_path, start, end in segments:
+        try:
+            with open(file_path, 'rb') as f:
+                if start > 0:
+                    # Skip the line that started in the previous range
+                    f.seek(start - 1)
+                    f.readline()
+                pos = f.tell()
+                while pos < end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    pos += len(line)
+                    tokens = line.decode('utf-8', errors='replace').split()
+                    for token in tokens:
+                        server_id = partition_cache.get(token)
+                        if server_id is None:
+                            server_id = owners[partition_hash(token) % partitions_num]
+                            if len(partition_cache) < partition_cache_size:
+                                partition_cache[token] = server_id
+                        if use_combiner:
+                            partition = partial.setdefault(server_id, {})
+                            partition[token] = partition.get(token, 0) + 1
+                        else:
+                            partial.setdefault(server_id, []).append(token)
+        except Exception as e:
+            print(f"ERROR building words_per_server: {e}")
 
-    # Send back response over socket
+    return partial
+
+
+def split_range_mmap(args):
+    # Same contract as split_range(), but whitespace splitting runs on raw bytes
+    # of the mmap and each distinct word is decoded and partitioned only once.
+    # bytes.split() only splits on ASCII whitespace, so decoded words are split
+    # again with str.split(), which also splits on U+00A0, U+3000, \x1c, etc.
+    segments, owners, partitioner, use_combiner, partition_cache_size, _ = args
+
+    partition_hash = partitioners[partitioner]
+    partitions_num = len(owners)
+    word_cache = {} # {word_bytes: [(word, server_id)]} bounded memo
+    partial = {} # same layout as words_per_server
+
+    for file_path, start, end in segments:
+        try:
+            with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for chunk_start, chunk_end in mmap_chunks(mm, start, end):
+                    counts = Counter(mm[chunk_start:chunk_end].split())
+
+                    for word_bytes, count in counts.items():
+                        entry = word_cache.get(word_bytes)
+                        if entry is None:
+                            entry = [(token, owners[partition_hash(token) % partitions_num])
+                                     for token in word_bytes.decode('utf-8', errors='replace').split()]
+                            if len(word_cache) < partition_cache_size:
+                                word_cache[word_bytes] = entry
+                        for token, server_id in entry:
+                            if use_combiner:
+                                partition = partial.setdefault(server_id, {})
+                                partition[token] = partition.get(token, 0) + count
+                            else:
+                                partial.setdefault(server_id, []).extend([token] * count)
+        except Exception as e:
+            print(f"ERROR building words_per_server: {e}")
+
+    return partial
+
+
+def mmap_chunks(mm, start, end, record_start=None):
+    # Yields (chunk_start, chunk_end) slices of about mmap_chunk_size bytes holding
+    # the whole lines that start in [start, end), like split_range(). With record_start,
+    # slices hold whole records instead, a record being the lines from one line that
+    # starts with record_start to the next one.
+    size = len(mm)
+    sep = b'\n' + (record_start or b'')
+    if start > 0:
+        nl = mm.find(sep, start - 1)
+        start = size if nl == -1 else nl + 1
+    nl = mm.find(sep, end - 1)
+    end = size if nl == -1 else nl + 1
+
+    pos = start
+    while pos < end:
+        chunk_end = min(pos + mmap_chunk_size, end)
+        if chunk_end < end:
+            nl = mm.find(sep, chunk_end - 1, end)
+            chunk_end = end if nl == -1 else nl + 1
+        yield pos, chunk_end
+        pos = chunk_end
+
+
+def split_range_job(args):
+    # Same contract as split_range() for a loaded job: its mapper runs once per
+    # chunk of whole lines, or whole records, and already returns combined {key: value} counts.
+    segments, owners, partitioner, use_combiner, partition_cache_size, job_module = args
+
+    job = load_job(job_module)
+    partition_hash = getattr(job, "partition", partitioners[partitioner])
+    combine = getattr(job, "combine", None)
+    record_start = getattr(job, "record_start", None)
+    partition_cache = {} # {key: server_id} bounded memo
+    partial = {} # {server_id: {key: value}}
+
+    for file_path, start, end in segments:
+        try:
+            with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for chunk_start, chunk_end in mmap_chunks(mm, start, end, record_start):
+                    counts = job.map_chunk(mm[chunk_start:chunk_end].decode('utf-8', errors='replace'))
+
+                    by_server = {}
+                    for key, value in counts.items():
+                        server_id = partition_cache.get(key)
+                        if server_id is None:
+                            server_id = owners[partition_hash(key) % len(owners)]
+                            if len(partition_cache) < partition_cache_size:
+                                partition_cache[key] = server_id
+                        by_server.setdefault(server_id, []).append((key, value))
+                    for server_id, items in by_server.items():
+                        merge_counts(partial.setdefault(server_id, {}), items, combine)
+        except Exception as e:
+            print(f"ERROR building words_per_server: {e}")
+
+    return partial
+
+
+def load_job(module_path):
+    # Job modules define:
+    #   map_chunk(text) -> {key: value}  mapper and combiner over a str of whole lines
+    #   combine(a, b) -> value           merges two values of a key (optional, default a + b)
+    #   reduce(key, value) -> value      final value of a key (optional, default value)
+    #   partition(key) -> int            hash identical on every machine (optional, default partitioner)
+    #   record_start = b"..."            start of the first line of a record, chunks then never cut a record (optional)
+    # Keys are str without tabs or newlines and values non-negative int, as the shuffle protocols carry them.
+    module = importlib.import_module(module_path)
+    if not hasattr(module, "map_chunk"):
+        raise ValueError(f"job {module_path} has no map_chunk()")
+    return module
+
+
+def merge_counts(target, items, combine=None):
+    # Merges (key, value) pairs into target, summing values unless combine is given
+    if combine is None:
+        for key, value in items:
+            target[key] = target.get(key, 0) + value
+    else:
+        for key, value in items:
+            target[key] = combine(target[key], value) if key in target else value
+    return target
+
+
+def job_combine():
+    return getattr(job, "combine", None) if job else None
+
+
+def local_byte_range(server=None):
+    # The dataset is cut in one contiguous slice per entry of owners, this server
+    # handles its own slice plus the ones of the failed servers reassigned to it.
+    # With server, returns the slices of another server instead.
+    files = list_input_files()
+    total_size = sum(size for _, size in files)
+    slices = [] # [(start, end)]
+    for p, owner in enumerate(owners):
+        if owner != (id if server is None else server):
+            continue
+        start = total_size * p // len(owners)
+        end = total_size * (p + 1) // len(owners)
+        if slices and slices[-1][1] == start:
+            slices[-1] = (slices[-1][0], end)
+        else:
+            slices.append((start, end))
+    if server is not None:
+        return files, slices
+    print(f"Server {id} splitting bytes {', '.join(f'{start}-{end}' for start, end in slices)} of {total_size}")
+    return files, slices
+
+
+def split_tasks(files, slices, parts):
+    # Cuts the slices into about parts equal split_range() tasks
+    size = sum(end - start for start, end in slices)
+    tasks = []
+    for start, end in slices:
+        n = max(1, round(parts * (end - start) / size)) if size else 1
+        for p in range(n):
+            p_start = start + (end - start) * p // n
+            p_end = start + (end - start) * (p + 1) // n
+            segments = byte_range_segments(files, p_start, p_end)
+            tasks.append((segments, owners, partitioner, use_combiner, partition_cache_size, job_module))
+    return tasks
+
+
+def split_function(job_module):
+    if job_module:
+        return split_range_job
+    return split_range_mmap if use_mmap else split_range
+
+
+def run_split_tasks(tasks, workers, split_func=None):
+    # Yields the partial partitions of the tasks as the local worker processes finish them
+    if split_func is None:
+        split_func = split_function(job_module)
+    if workers == 1:
+        for task in tasks:
+            yield split_func(task)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            yield from pool.imap_unordered(split_func, tasks)
+
+
+# ======= Incremental SPLIT =======
+# Every input file is cut in blocks of split_block_size bytes, each block is mapped
+# once into {partition: {word: count}} for the logical partitions of owners and
+# cached in split_cache_folder. A cache file is a JSON key line (file, block, size,
+# mtime and partitioning) followed by one SPLIT_CACHE_SECTION (partition, payload
+# length) and zlib compressed payload per partition, encoded like FRAME_SHUFFLEC.
+SPLIT_CACHE_SECTION = struct.Struct('>II')
+
+
+def input_blocks():
+    # Returns the (file_path, start, end) blocks of this server. Blocks are spread over
+    # the entries of owners largest first, to the least loaded one. Their cache only
+    # depends on their own file, so a block moved to another server is still a hit
+    # there if split_cache_folder is shared between the servers.
+    blocks = []
+    for file_path, size in list_input_files():
+        for start in range(0, size, split_block_size):
+            blocks.append((file_path, start, min(start + split_block_size, size)))
+    loads = [(0, p) for p in range(len(owners))] # heap of (bytes, partition)
+    local = []
+    for block in sorted(blocks, key=lambda b: (b[1] - b[2], b)):
+        load, p = heapq.heappop(loads)
+        heapq.heappush(loads, (load + block[2] - block[1], p))
+        if owners[p] == id:
+            local.append(block)
+    return local
+
+
+def split_cache_key(block):
+    file_path, start, end = block
+    stat = os.stat(file_path)
+    return {
+        "file": os.path.realpath(file_path), "start": start, "end": end,
+        "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+        "partitioner": partitioner, "partitions": len(owners), "job": job_module,
+    }
+
+
+def split_cache_path(key):
+    name = hashlib.sha1(f"{key['file']}:{key['start']}:{key['partitions']}:{key['job']}".encode()).hexdigest()
+    return os.path.join(split_cache_folder, f"{name}.split")
+
+
+def read_split_cache(path, key):
+    # Returns the cached partial of a block, None if it is missing or stale
     try:
-        out.write("SPLIT_OK\n")
-        out.flush()
-    except Exception as e:
-        print(f"ERROR: server {id} write to out error: {e}")
+        with open(path, 'rb') as f:
+            if json.loads(f.readline()) != key:
+                return None
+            partial = {}
+            while True:
+                header = f.read(SPLIT_CACHE_SECTION.size)
+                if not header:
+                    return partial
+                p, length = SPLIT_CACHE_SECTION.unpack(header)
+                partial[p] = dict(decode_words(zlib.decompress(f.read(length)), 0, True))
+    except (OSError, ValueError, struct.error, zlib.error):
+        return None
+
+
+def write_split_cache(path, key, partial):
+    # Written next to the cache file and renamed, readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(key).encode() + b"\n")
+            for p, words in partial.items():
+                payload = bytearray()
+                for word, count in words.items():
+                    data = word.encode()
+                    write_varint(payload, len(data))
+                    payload += data
+                    write_varint(payload, count)
+                payload = zlib.compress(payload, 1)
+                f.write(SPLIT_CACHE_SECTION.pack(p, len(payload)))
+                f.write(payload)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"ERROR: server {id} could not cache {key['file']} at {path}: {e}")
+
+
+def split_cached_block(args):
+    # SPLIT worker task of one block, returns (file_path, hit, partial) with partial
+    # keyed by logical partition, loaded from the cache or mapped and then cached
+    file_path, path, key, task = args
+    partial = read_split_cache(path, key)
+    if partial is not None:
+        return file_path, True, partial
+    partial = split_function(task[5])(task)
+    write_split_cache(path, key, partial)
+    return file_path, False, partial
+
+
+def run_cached_split():
+    # Same as run_split_tasks() over the blocks of this server, the per-file cache hits
+    # and misses are sent to the controller in the split_cache metric
+    os.makedirs(split_cache_folder, exist_ok=True)
+    blocks = input_blocks()
+    print(f"Server {id} splitting {len(blocks)} blocks of up to {split_block_size} bytes")
+    partitions = list(range(len(owners)))
+    tasks = []
+    for block in blocks:
+        key = split_cache_key(block)
+        task = ([block], partitions, partitioner, True, partition_cache_size, job_module)
+        tasks.append((block[0], split_cache_path(key), key, task))
+
+    workers = max(1, min(split_workers, len(tasks)))
+    cache = {} # {file_path: {"hits": blocks, "misses": blocks}}
+    for file_path, hit, partial in run_split_tasks(tasks, workers, split_cached_block):
+        stats = cache.setdefault(file_path, {"hits": 0, "misses": 0})
+        stats["hits" if hit else "misses"] += 1
+        # Logical partitions to the servers owning them
+        owned = {}
+        for p, words in partial.items():
+            if owners[p] in owned:
+                merge_counts(owned[owners[p]], words.items(), job_combine())
+            else:
+                owned[owners[p]] = words
+        yield owned
+    if metrics:
+        metrics.values["split_cache"] = cache
+
+
+def split_partials(chunk_size=None):
+    # Yields the partial partitions of this server's input, split in tasks of about
+    # chunk_size bytes or in one task per local worker process
+    if split_cache_folder and use_combiner:
+        yield from run_cached_split()
+        return
+    files, slices = local_byte_range()
+    size = sum(end - start for start, end in slices)
+    workers = max(1, min(split_workers, size))
+    parts = max(workers, -(-size // chunk_size)) if chunk_size else workers
+    yield from run_split_tasks(split_tasks(files, slices, parts), workers)
+
+
+# ======= Speculative SPLIT =======
+# With speculation, a server splits its slices in units of speculation_unit_size
+# bytes, merged strictly in input order, and its heartbeats carry how many are
+# merged. The controller can ask an idle server to SPECULATE on the units of a
+# straggler from the last one backwards, then stops both once they met: the
+# straggler keeps the units it merged, the backup only merges the ones after.
+def split_units(server):
+    # SPLIT tasks of a server's slices, the same on every server
+    files, slices = local_byte_range(server)
+    size = sum(end - start for start, end in slices)
+    return split_tasks(files, slices, max(1, -(-size // speculation_unit_size)))
+
+
+def control_command():
+    # Line sent by the controller while the main thread is busy, None if there is none
+    if select.select([server_socket], [], [], 0)[0]:
+        return inp.readline().strip()
+    return None
+
+
+def run_units(tasks, order, on_partial, stop_command):
+    # Runs the tasks in order on the local worker processes and passes each partial to
+    # on_partial(unit, partial) in that order, until they are all done or the controller
+    # sends stop_command. Returns the number of partials passed on.
+    global split_progress
+    split_func = split_function(job_module)
+    workers = max(1, min(split_workers, len(order)))
+    done = 0
+    split_progress = (0, len(order))
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.imap(split_func, [tasks[unit] for unit in order])
+            while done < len(order):
+                try:
+                    partial = results.next(timeout=heartbeat_interval)
+                    on_partial(order[done], partial)
+                    done += 1
+                    split_progress = (done, len(order))
+                except multiprocessing.TimeoutError:
+                    pass
+                # Leaving the pool terminates the workers still splitting
+                if control_command() == stop_command:
+                    break
+    finally:
+        split_progress = None
+    return done
 
 
-def shuffle():
-    global peer_outputs, thread_listeners
+def merge_split_partial(partial):
+    # Merges a partial into words_per_server, returns its number of tokens
+    for server_id, words in partial.items():
+        if server_id not in words_per_server:
+            words_per_server[server_id] = words
+        else:
+            merge_partition(words_per_server[server_id], words)
+    return count_tokens(partial)
+
+
+def speculate(server, first):
+    # Backup of a straggler: splits its units from the last one down to first, then
+    # merges the ones the controller commits, those the straggler did not merge
+    print(f"Server {id} speculating on the SPLIT units {first}+ of server {server}.")
+    tasks = split_units(server)
+    order = list(range(len(tasks) - 1, first - 1, -1))
+    held = {} # {unit: partial} until the commit
+    done = run_units(tasks, order, held.__setitem__, "SPECULATE_STOP")
+    lowest = order[done - 1] if done else len(tasks)
+    # No metrics, the controller only gets them once per phase from every server,
+    # the tokens of the merged units are added to this server's SPLIT ones instead
+    out.write(f"SPECULATE_OK;{lowest}\n")
+    out.flush()
+
+    line = inp.readline().strip()
+    while line == "SPECULATE_STOP":
+        # Sent while this server was finishing on its own
+        line = inp.readline().strip()
+    committed = int(line.split(';')[1]) if line.startswith("SPECULATE_COMMIT;") else len(tasks)
+    tokens = 0
+    for unit in sorted(held):
+        if unit >= committed:
+            tokens += merge_split_partial(held[unit])
+    print(f"Server {id} kept {sum(unit >= committed for unit in held)} of the {len(held)} units split for server {server}.")
+    out.write(f"SPECULATE_COMMIT_OK;{tokens}\n")
+    out.flush()
+
+
+def merge_partition(partition, words):
+    # Merges words (same layout as a words_per_server value) into partition and returns it
+    if use_combiner:
+        merge_counts(partition, words.items(), job_combine())
+    else:
+        partition.extend(words)
+    return partition
 
-    print(f"Started SHUFFLE on server {id}.")
 
-    # Open listener threads
-    thread_listeners = start_thread_listeners(servers_num, server_port, id)
-    time.sleep(0.5)
+def split():
+    global words_per_server
+    print(f"Started SPLIT on server {id}.")
 
-    # Open socket client connections to other peers
-    peer_outputs = connect_to_peers(servers_num, server_port, id, servers)
+    if speculation and not (split_cache_folder and use_combiner):
+        # The controller may stop this server once a backup split its last units
+        local_byte_range()
+        tasks = split_units(id)
+        done = run_units(tasks, range(len(tasks)), lambda unit, partial: add_metric("tokens", merge_split_partial(partial)), "SPLIT_STOP")
+        response = f"SPLIT_OK;{done}"
+    else:
+        # The local slices are further sliced between the local worker processes,
+        # then their partial partitions are merged
+        for partial in split_partials():
+            add_metric("tokens", merge_split_partial(partial))
+        response = "SPLIT_OK"
 
-    for svr_idx, word_list in words_per_server.items():
-        if svr_idx in servers and svr_idx != id:
-            try:
-                peer_outputs[svr_idx].write("SHUFFLE;")
-                peer_outputs[svr_idx].write(";".join(word_list))
+    # Send back response over socket
+    try:
+        out.write(ok_line(response))
+        out.flush()
+    except Exception as e:
+        print(f"ERROR: server {id} write to out error: {e}")
+
+
+def send_partition(svr_idx, word_list):
+    # Sends one batch of words to a peer, or keeps it locally if svr_idx is this server
+    if svr_idx in servers and svr_idx != id:
+        try:
+            if wire_protocol == "binary":
+                if intern_words:
+                    write_interned_frames(peer_outputs[svr_idx], word_list.items())
+                elif use_combiner:
+                    write_word_frames(peer_outputs[svr_idx], FRAME_SHUFFLEC, word_list.items())
+                else:
+                    write_word_frames(peer_outputs[svr_idx], FRAME_SHUFFLE, word_list)
+            elif use_combiner:
+                # word_list is a {word: count} dict: send "SHUFFLEC\tword\tcount\tword\tcount\t...",
+                # text lines are tab separated, see ShuffleReceiver.handle_line()
+                peer_outputs[svr_idx].write("SHUFFLEC\t")
+                peer_outputs[svr_idx].write("\t".join(f"{word}\t{count}" for word, count in word_list.items()))
                 peer_outputs[svr_idx].write("\n")
-                peer_outputs[svr_idx].flush()
-                print(f"Server {id} sent {len(word_list)} words to server {svr_idx}")
-            except Exception as e:
-                print(f"ERROR: server {id} write to peer_outputs error: {e}")
+            else:
+                peer_outputs[svr_idx].write("SHUFFLE\t")
+                peer_outputs[svr_idx].write("\t".join(word_list))
+                peer_outputs[svr_idx].write("\n")
+            peer_outputs[svr_idx].flush()
+            print(f"Server {id} sent {len(word_list)} words to server {svr_idx}")
+        except Exception as e:
+            print(f"ERROR: server {id} write to peer_outputs error: {e}")
 
+    else:
+        if intern_words:
+            word_count_list.add_items(word_list.items())
+        elif use_combiner:
+            merge_counts(word_count_list, word_list.items(), job_combine())
         else:
             for token in word_list:
-                word_count_list.setdefault(token,[]).append(1)
-            print(f"Server {id} kept {len(word_list)} words locally.")
-            
+                word_count_list[token] = word_count_list.get(token, 0) + 1
+        word_count_runs.maybe_spill(word_count_list, len(word_count_list))
+        print(f"Server {id} kept {len(word_list)} words locally.")
 
+
+def send_finish():
     # Send FINISH signal to other servers to terminate their listener loops
     for i in range(servers_num):
         if i == id:
             continue
         try:
-            peer_outputs[i].write("FINISH\n")
+            if wire_protocol == "binary":
+                peer_outputs[i].write_frame(FRAME_FINISH, b"")
+                # The peer forgets the IDs of this round's words with the FINISH
+                peer_outputs[i].word_ids.clear()
+            else:
+                peer_outputs[i].write("FINISH\n")
             peer_outputs[i].flush()
         except Exception as e:
             print(f"ERROR: server {id}] write to peer_outputs error: {e}")
 
+
+def open_peer_connections():
+    global peer_outputs, thread_listeners
+
+    # Open listener threads
+    thread_listeners = start_thread_listeners(servers_num, server_port, id)
+
+    # Open socket client connections to other peers
+    peer_outputs = connect_to_peers(servers_num, server_port, id, servers)
+
+
+def start_round():
+    # Each shuffle round opens its own connections, unless the mesh persists for the whole job
+    if not persistent_mesh:
+        open_peer_connections()
+    for w in peer_outputs:
+        if w is not None:
+            w.reset_stats()
+
+
+def shuffle():
+    print(f"Started SHUFFLE on server {id}.")
+
+    start_round()
+
+    for svr_idx, word_list in words_per_server.items():
+        send_partition(svr_idx, word_list)
+
+    send_finish()
+
     # Send back response to controller
     try:
-        out.write("SHUFFLE_OK\n")
+        out.write(ok_line(f"SHUFFLE_OK;{peer_stats()}"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write to out error: {e}")
 
 
+def split_shuffle():
+    # Pipelined SPLIT + SHUFFLE: partial partitions are sent to their peers in
+    # batches of shuffle_batch_size words while the rest of the input is still
+    # being split, so only the unsent batches are held in memory.
+    print(f"Started SPLIT_SHUFFLE on server {id}.")
+
+    start_round()
+
+    # Small tasks so that batches start flowing before the whole slice is split
+    send_buffers = {} # {server_id: words} not yet sent
+    for partial in split_partials(stream_chunk_size):
+        add_metric("tokens", count_tokens(partial))
+        for server_id, words in partial.items():
+            if server_id == id:
+                send_partition(server_id, words)
+                continue
+            if server_id not in send_buffers:
+                send_buffers[server_id] = words
+            else:
+                merge_partition(send_buffers[server_id], words)
+            if len(send_buffers[server_id]) >= shuffle_batch_size:
+                send_partition(server_id, send_buffers.pop(server_id))
+
+    for server_id, words in send_buffers.items():
+        send_partition(server_id, words)
+
+    send_finish()
+
+    try:
+        out.write(ok_line(f"SPLIT_SHUFFLE_OK;{peer_stats()}"))
+        out.flush()
+    except Exception as e:
+        print(f"ERROR: server {id} write to out error: {e}")
+
 
 def synchronize():
     print(f"Started SYNCHRONIZE on server {id}.")
@@ -121,7 +763,7 @@ def synchronize():
 
     # send back
     try:
-        out.write("SYNCHRONIZE_OK\n")
+        out.write(ok_line("SYNCHRONIZE_OK"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write to out error: {e}")
@@ -132,13 +774,22 @@ def group():
 
     # group the word counts from all threads
     for thread in thread_listeners:
-        if thread is not None:
-            for word, counts in thread.get_word_count_list().items():
-                word_count_list.setdefault(word,[]).extend(counts)
+        if thread is None:
+            continue
+        if memory_budget_words:
+            # Merged with the spilled runs during REDUCE instead of in memory
+            word_count_runs.adopt(thread.word_count_runs, thread.get_word_count_list())
+        elif intern_words:
+            word_count_list.merge(thread.get_word_count_list())
+        else:
+            merge_counts(word_count_list, thread.get_word_count_list().items(), job_combine())
+    if intern_words:
+        # Every word arrived, REDUCE only goes through the ID arrays
+        word_count_list.seal()
 
     # send back
     try:
-        out.write("GROUP_OK\n")
+        out.write(ok_line("GROUP_OK"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write to out error: {e}")
@@ -146,32 +797,24 @@ def group():
 def reduce():
     print(f"Started REDUCE on server {id}.")
 
-    # REDUCE the max and min count of each word
-    max_count = float('-inf')
-    min_count = float('inf')
-
-    for word, counts in word_count_list.items():
-        total = sum(counts)
-        max_count = max(max_count, total)
-        min_count = min(min_count, total)
-
-        # merge into count_word_list: {count: [words]}
-        count_word_list.setdefault(total,[]).append(word)
-
-    # handle empty case
-    if max_count == float('-inf') or min_count == float('inf'):
-        max_count, min_count = 0, 0
+    job_reduce = getattr(job, "reduce", None) if job else None
+    if np is not None and use_numpy and not job_reduce and not memory_budget_words:
+        max_count, min_count, histogram = reduce_numpy()
+    else:
+        max_count, min_count, histogram = reduce_python(job_reduce)
 
     # send back REDUCE_OK
     try:
-        out.write("REDUCE_OK\n")
+        out.write(ok_line("REDUCE_OK"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write to out error: {e}")
+    start_phase("RANGE")
 
-    # send max;min
+    # send max;min;histogram where the histogram is "count:words,count:words,..."
     try:
-        out.write(f"{max_count};{min_count}\n")
+        histogram = ",".join(f"{count}:{words}" for count, words in histogram.items())
+        out.write(f"{max_count};{min_count};{histogram}\n")
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write max/min to out error: {e}")
@@ -191,52 +834,120 @@ def reduce():
     except Exception as e:
         print(f"ERROR: server {id}] reading range error: {e}")
 
+    # Lookup table routing a count to its server with a binary search, "0,0" ranges are empty
+    bounds = sorted((min_val, idx) for idx, (max_val, min_val) in ranges.items() if max_val > 0)
+    range_mins[:] = [min_val for min_val, _ in bounds]
+    range_ids[:] = [idx for _, idx in bounds]
+
     # send back RANGE_OK
     try:
-        out.write("RANGE_OK\n")
+        out.write(ok_line("RANGE_OK"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id}] write RANGE_OK error: {e}")
 
+def reduce_python(job_reduce=None):
+    # Builds count_word_list from word_count_list, its spilled runs included, and
+    # returns the max and min count and the {count: number of words} histogram
+    max_count = float('-inf')
+    min_count = float('inf')
+
+    histogram = {} # {count: number of words}
+    held = 0
+    for word, total in word_count_runs.items(word_count_list):
+        if job_reduce:
+            total = job_reduce(word, total)
+        max_count = max(max_count, total)
+        min_count = min(min_count, total)
+        histogram[total] = histogram.get(total, 0) + 1
+
+        # merge into count_word_list: {count: [words]}
+        count_word_list.setdefault(total,[]).append(word)
+        held += 1
+        if count_word_runs.maybe_spill(count_word_list, held):
+            held = 0
+
+    # handle empty case
+    if max_count == float('-inf') or min_count == float('inf'):
+        max_count, min_count = 0, 0
+    return max_count, min_count, histogram
+
+
+def reduce_numpy():
+    # Same as reduce_python() with the counts in memory: one stable sort by decreasing
+    # count groups the words, the histogram is the size of each group
+    if not len(word_count_list):
+        return 0, 0, {}
+    if isinstance(word_count_list, WordTable):
+        words = word_count_list.words
+        counts = np.frombuffer(word_count_list.counts, dtype=np.int64)
+    else:
+        words = list(word_count_list)
+        counts = np.fromiter(word_count_list.values(), dtype=np.int64, count=len(words))
+
+    order = np.argsort(-counts, kind='stable')
+    sorted_counts = counts[order]
+    starts = np.flatnonzero(np.diff(sorted_counts)) + 1
+    ends = np.append(starts, len(words)).tolist()
+    starts = [0] + starts.tolist()
+    values = sorted_counts[starts].tolist()
+    sorted_words = np.array(words, dtype=object)[order]
+
+    histogram = {}
+    for count, start, end in zip(values, starts, ends):
+        count_word_list.setdefault(count, []).extend(sorted_words[start:end].tolist())
+        histogram[count] = end - start
+    return values[0], values[-1], histogram
+
+
+def route_counts(counts):
+    # server_id of the SHUFFLE2 range holding each count
+    if np is not None and use_numpy:
+        idx = np.searchsorted(np.asarray(range_mins), np.asarray(counts), side='right') - 1
+        return np.asarray(range_ids)[np.maximum(idx, 0)].tolist()
+    return [range_ids[max(0, bisect.bisect_right(range_mins, count) - 1)] for count in counts]
+
+
 def shuffle2():
     print(f"Started SHUFFLE2 on server {id}.")
 
-    global thread_listeners, peer_outputs
-    thread_listeners = start_thread_listeners(servers_num, server_port, id)
-    time.sleep(0.5)
-    peer_outputs = connect_to_peers(servers_num, server_port, id, servers)
+    start_round()
 
-    for count, word_list in count_word_list.items():
-        for idx, (max_val, min_val) in ranges.items():
-            if min_val <= count <= max_val:
-                target_server_idx = idx
-                break
+    # The in-memory counts are routed at once, the spilled ones as they come
+    targets = dict(zip(count_word_list, route_counts(list(count_word_list)))) if count_word_list else {}
+    held = 0
+    for count, word_list in count_word_runs.items(count_word_list):
+        target_server_idx = targets.get(count)
+        if target_server_idx is None:
+            target_server_idx = route_counts([count])[0]
         if target_server_idx != id:
             try:
-                peer_outputs[target_server_idx].write(f"SHUFFLE2;{count};")
-                peer_outputs[target_server_idx].write(";".join(word_list))
-                peer_outputs[target_server_idx].write("\n")
-                peer_outputs[target_server_idx].flush()
+                if wire_protocol == "binary":
+                    # Frames are only flushed with FINISH, many counts share a TCP segment
+                    prefix = bytearray()
+                    write_varint(prefix, count)
+                    write_word_frames(peer_outputs[target_server_idx], FRAME_SHUFFLE2, word_list, prefix)
+                else:
+                    peer_outputs[target_server_idx].write(f"SHUFFLE2\t{count}\t")
+                    peer_outputs[target_server_idx].write("\t".join(word_list))
+                    peer_outputs[target_server_idx].write("\n")
+                    peer_outputs[target_server_idx].flush()
             except Exception as e:
                 print(f"ERROR: server {id} flush error: {e}")
 
         else:
             final_count_word_list.setdefault(count,[]).extend(word_list)
+            held += len(word_list)
+            if final_count_word_runs.maybe_spill(final_count_word_list, held):
+                held = 0
 
 
     # send FINISH to end conversations
-    for i in range(servers_num):
-        if i == id:
-            continue
-        try:
-            peer_outputs[i].write("FINISH\n")
-            peer_outputs[i].flush()
-        except Exception as e:
-            print(f"ERROR: server {id} sent finish error: {e}")
+    send_finish()
 
     # send back SHUFFLE2_OK
     try:
-        out.write("SHUFFLE2_OK\n")
+        out.write(ok_line(f"SHUFFLE2_OK;{peer_stats()}"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write SHUFFLE2_OK error: {e}")
@@ -247,7 +958,7 @@ def synchronize2():
 
     # send back
     try:
-        out.write("SYNCHRONIZE2_OK\n")
+        out.write(ok_line("SYNCHRONIZE2_OK"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write to out error: {e}")
@@ -256,28 +967,73 @@ def group2():
     print(f"Started GROUP2 on server {id}.")
 
     for thread in thread_listeners:
-        if thread is not None:
+        if thread is None:
+            continue
+        if memory_budget_words:
+            final_count_word_runs.adopt(thread.count_word_runs, thread.get_count_word_list())
+        else:
             for count, words in thread.get_count_word_list().items():
                 final_count_word_list.setdefault(count,[]).extend(words)
 
     # send back
     try:
-        out.write("GROUP2_OK\n")
+        out.write(ok_line("GROUP2_OK"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write to out error: {e}")
 
+def sorted_output(top_k=None):
+    # Streams the reduced counts to the controller as "count\tword\tword\t..." lines by
+    # decreasing count, for a k-way merge on the controller instead of SHUFFLE2.
+    # Words live on a single server after SHUFFLE, so local top-K lists are exact.
+    marker = "MERGE_OK" if top_k is None else "TOPK_OK"
+    print(f"Started {marker[:-3]} on server {id}.")
+
+    sent = 0
+    try:
+        for count, words in count_word_runs.items(count_word_list):
+            if top_k is not None:
+                words = words[:top_k - sent]
+            out.write(f"{count}\t" + "\t".join(words) + "\n")
+            sent += len(words)
+            if top_k is not None and sent >= top_k:
+                break
+        out.write(ok_line(marker))
+        out.flush()
+    except Exception as e:
+        print(f"ERROR: server {id} write sorted output error: {e}")
+
+def init_spill_runs():
+    global word_count_runs, count_word_runs, final_count_word_runs
+    word_count_runs = SpillRuns(False)
+    count_word_runs = SpillRuns(True)
+    final_count_word_runs = SpillRuns(True)
+
 def quit():
-    if save_results:
-        with open("word_count.txt", "a") as f:
-            output = ""
-            for count, words in sorted(final_count_word_list.items(), reverse=True):
-                output += f"{count}: {', '.join(words)}\n"
-            f.write(output)
+    global quitting
+    quitting = True
+    if save_results and results_format == "columnar":
+        with CountFileWriter(results_file.format(id=id)) as writer:
+            for count, words in final_count_word_runs.items(final_count_word_list):
+                writer.write(count, words)
+    elif save_results:
+        with open(results_file.format(id=id), "a") as f:
+            # Spilled counts come back in batches, a count keeps a single line
+            previous = None
+            for count, words in final_count_word_runs.items(final_count_word_list):
+                if count == previous:
+                    f.write(f", {', '.join(words)}")
+                    continue
+                if previous is not None:
+                    f.write("\n")
+                f.write(f"{count}: {', '.join(words)}")
+                previous = count
+            if previous is not None:
+                f.write("\n")
 
     print(f"Finished on server {id}.")
     try:
-        out.write("QUIT_OK\n")
+        out.write(ok_line("QUIT_OK"))
         out.flush()
     except Exception as e:
         print(f"ERROR: server {id} write QUIT_OK error: {e}")
@@ -291,27 +1047,36 @@ def quit():
                 continue
             sockets[i].close()
             peer_outputs[i].close()
-            thread_listeners[i].closeThread()
+        for thread in thread_listeners:
+            if thread is not None:
+                thread.closeThread()
     except Exception as e:
         print(f"ERROR: server {id} close error: {e}")
 
 
 def wait_threads(thread_listeners):
-    for i in range(servers_num):
-        if i == id:
+    if persistent_mesh:
+        # Listeners outlive the round, wait for the FINISH of every peer instead
+        for thread in thread_listeners:
+            if thread is not None:
+                thread.wait_round()
+        print(f"Server {id}: all peers finished the round.")
+        return
+
+    for i, thread in enumerate(thread_listeners):
+        if thread is None:
             continue
         try:
-            thread_listeners[i].join()
+            thread.join()
         except Exception as e:
             print(f"ERROR: server {id} Thread {i} join failed: {e}")
 
     print(f"Server {id}: all threads are ready.")
 
     # close thread listeners
-    for i in range(servers_num):
-        if i == id:
-            continue
-        thread_listeners[i].closeThread()
+    for thread in thread_listeners:
+        if thread is not None:
+            thread.closeThread()
 
 
 def connect_to_peers(servers_num, server_port, id, servers):
@@ -324,17 +1089,43 @@ def connect_to_peers(servers_num, server_port, id, servers):
         if i == id:
             continue
         try:
-            target_port = server_port + id + 1
-            s = socket.create_connection((servers[i], target_port))
+            target_port = server_ports[i] + 1 if shuffle_server == "selectors" else server_ports[i] + id + 1
+            s = connect_with_retry(servers[i], target_port)
             sockets[i] = s
-            peer_outputs[i] = s.makefile('w')
+            peer_outputs[i] = PeerWriter(s, i)
+            # Identifies this server to a selectors shuffle server
+            if wire_protocol == "binary":
+                hello = bytearray()
+                write_varint(hello, id)
+                peer_outputs[i].write_frame(FRAME_HELLO, hello)
+            else:
+                peer_outputs[i].write(f"HELLO;{id}\n")
             print(f"Server {id} connected to server {i} on port {target_port} successfully!")
         except Exception as e:
+            # Its words would be dropped and the peer would wait for a FINISH forever,
+            # failing the phase lets the controller re-execute the job instead
             print(f"ERROR: server {id} failed to connect to server {i} port {target_port}: {e}")
+            raise
     return peer_outputs
 
 
+def connect_with_retry(address, port):
+    # Peers may not be listening yet, back off exponentially between attempts
+    delay = connect_backoff
+    for attempt in range(connect_retries):
+        try:
+            return socket.create_connection((address, port))
+        except OSError:
+            if attempt == connect_retries - 1:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, connect_backoff_max)
+
+
 def start_thread_listeners(servers_num, server_port, id):
+    if shuffle_server == "selectors":
+        return start_shuffle_server(servers_num, server_port, id)
+
     thread_listeners = [None] * servers_num
     for i in range(servers_num):
         if i == id:
@@ -343,10 +1134,10 @@ def start_thread_listeners(servers_num, server_port, id):
             port = server_port + i + 1
             listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            listener.bind(('', port))
+            listener.bind((bind_address, port))
             listener.listen(1)
             print(f"Server {id} listening on port {port}...")
-            l = Listener(listener)
+            l = Listener(listener, i)
             thread_listeners[i] = l
             l.start()
         except Exception as e:
@@ -354,19 +1145,255 @@ def start_thread_listeners(servers_num, server_port, id):
     return thread_listeners
 
 
-class Listener(threading.Thread):
-    def __init__(self, listener):
-        super().__init__()
-        self.listener = listener  # ServerSocket
-        self.word_count_list= {}  # {word: [count]} for SHUFFLE
+def start_shuffle_server(servers_num, server_port, id):
+    # Returns a thread_listeners list holding the single ShuffleServer
+    if servers_num == 1:
+        return []
+    port = server_port + 1
+    try:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((bind_address, port))
+        listener.listen(servers_num)
+        print(f"Server {id} listening on port {port}...")
+        shuffle_server_thread = ShuffleServer(listener, servers_num - 1)
+        shuffle_server_thread.start()
+        return [shuffle_server_thread]
+    except Exception as e:
+        print(f"ERROR: server {id} failed to start shuffle server on port {port}: {e}")
+        return [None]
+
+
+class SpillRuns:
+    # Sorted runs of a {word: count} (by_count False) or {count: [words]} (by_count True)
+    # dict, written to disk once the dict holds memory_budget_words words and merged
+    # back with a streaming k-way merge. Runs are "word\tcount" lines sorted by word,
+    # or "count\tword" lines by decreasing count, and are deleted once read.
+    def __init__(self, by_count):
+        self.by_count = by_count
+        self.paths = []
+
+    def maybe_spill(self, data, held):
+        # Returns True if data was spilled and cleared
+        if not memory_budget_words or held < memory_budget_words:
+            return False
+        self.spill(data)
+        return True
+
+    def spill(self, data):
+        if not data:
+            return
+        fd, path = tempfile.mkstemp(prefix=f"server{id}-", suffix=".run", dir=spill_folder)
+        with open(fd, "w", encoding="utf-8", buffering=1024 * 1024) as f:
+            if self.by_count:
+                for count in sorted(data, reverse=True):
+                    f.writelines(f"{count}\t{word}\n" for word in data[count])
+            else:
+                f.writelines(f"{word}\t{count}\n" for word, count in sorted(data.items()))
+        print(f"Server {id} spilled {len(data)} entries to {path}")
+        self.paths.append(path)
+        data.clear()
+
+    def adopt(self, other, data):
+        # Takes over the runs of another SpillRuns, spilling its in-memory data first
+        other.spill(data)
+        self.paths.extend(other.paths)
+        other.paths = []
+
+    def read_run(self, path):
+        with open(path, encoding="utf-8", buffering=1024 * 1024) as f:
+            for line in f:
+                if self.by_count:
+                    count, _, word = line.rstrip("\n").partition("\t")
+                    yield int(count), word
+                else:
+                    word, _, count = line.rstrip("\n").rpartition("\t")
+                    yield word, int(count)
+
+    def items(self, data):
+        # Yields the (word, count) items of data merged with the runs, sorted by word,
+        # or (count, [words]) batches by decreasing count. Without runs data is used as is.
+        if not self.paths:
+            return iter(sorted(data.items(), reverse=True)) if self.by_count else iter(data.items())
+        return self.merge(data)
+
+    def merge(self, data):
+        paths, self.paths = self.paths, []
+        try:
+            if self.by_count:
+                memory = ((count, word) for count in sorted(data, reverse=True) for word in data[count])
+                merged = heapq.merge(memory, *map(self.read_run, paths), key=lambda item: -item[0])
+                for count, group in itertools.groupby(merged, key=lambda item: item[0]):
+                    while True:
+                        words = [word for _, word in itertools.islice(group, shuffle_batch_size)]
+                        if not words:
+                            break
+                        yield count, words
+            else:
+                combine = job_combine()
+                merged = heapq.merge(sorted(data.items()), *map(self.read_run, paths), key=lambda item: item[0])
+                for word, group in itertools.groupby(merged, key=lambda item: item[0]):
+                    if combine is None:
+                        yield word, sum(count for _, count in group)
+                    else:
+                        counts = [count for _, count in group]
+                        total = counts[0]
+                        for count in counts[1:]:
+                            total = combine(total, count)
+                        yield word, total
+            data.clear()
+        finally:
+            for path in paths:
+                os.remove(path)
+
+
+class WordTable:
+    # Interned {word: count} of intern_words: every word gets a dense ID on its first
+    # occurrence and counts are summed in an array indexed by ID, not in dict values
+    def __init__(self):
+        self.ids = {}  # {word: ID}, dropped by seal()
+        self.words = []  # word of each ID
+        self.counts = array('q')  # count of each ID
+
+    def __len__(self):
+        return len(self.words)
+
+    def intern(self, word):
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+            self.counts.append(0)
+        return word_id
+
+    def add_items(self, items):
+        counts = self.counts
+        for word, count in items:
+            counts[self.intern(word)] += count
+
+    def merge(self, other):
+        # Adds the counts of another table, interning each of its words once
+        counts = self.counts
+        for word_id, count in zip(map(self.intern, other.words), other.counts):
+            counts[word_id] += count
+
+    def seal(self):
+        # No word is added anymore, only the ID arrays are kept
+        self.ids = None
+
+    def items(self):
+        return zip(self.words, self.counts)
+
+
+class ShuffleReceiver:
+    # Accumulates the words received from peers, in text lines or binary frames
+    def __init__(self):
+        self.word_count_list= WordTable() if intern_words else {}  # {word: count} for SHUFFLE
+        self.sender_ids = {}  # {sender: [WordTable ID of each word ID of the sender]} for FRAME_SHUFFLEI
         self.count_word_list = {}  # {count: [words]} for SHUFFLE2
+        self.count_word_held = 0  # words in count_word_list
+        self.bytes_received = {}  # {peer: bytes} since the last SYNCHRONIZE
+        self.word_count_runs = SpillRuns(False)
+        self.count_word_runs = SpillRuns(True)
+        self.round_finished = threading.Event()  # set when the senders are done with the round
+
+    def wait_round(self):
+        self.round_finished.wait()
+        self.round_finished.clear()
 
     def get_word_count_list(self):
         return self.word_count_list
 
     def get_count_word_list(self):
         return self.count_word_list
-    
+
+    def handle_line(self, line):
+        # Returns False once the sender is done. Fields are tab separated, since a
+        # whitespace split token cannot hold a tab but may hold a ";"
+        tokens = line.rstrip("\n").split('\t')
+        if tokens[0] == "SHUFFLE":
+            word_count_list = self.word_count_list
+            for token in tokens[1:]:
+                word_count_list[token] = word_count_list.get(token, 0) + 1
+            self.word_count_runs.maybe_spill(word_count_list, len(word_count_list))
+            print(f"Server {id} received {len(tokens)-1} words")
+
+        elif tokens[0] == "SHUFFLEC":
+            # Combined pairs: word\tcount\tword\tcount\t...
+            pairs = ((tokens[i], int(tokens[i + 1])) for i in range(1, len(tokens) - 1, 2))
+            merge_counts(self.word_count_list, pairs, job_combine())
+            self.word_count_runs.maybe_spill(self.word_count_list, len(self.word_count_list))
+            print(f"Server {id} received {(len(tokens)-1) // 2} distinct words")
+
+        elif tokens[0] == "SHUFFLE2":
+            count = int(tokens[1])
+            self.count_word_list.setdefault(count,[]).extend(tokens[2:])
+            self.hold_count_words(len(tokens) - 2)
+
+        elif tokens[0] == "FINISH":
+            return False
+        return True
+
+    def handle_frame(self, frame_type, payload, sender):
+        # Returns False once the sender is done
+        if frame_type == FRAME_SHUFFLEI:
+            table = self.word_count_list
+            counts = table.counts
+            ids = self.sender_ids.setdefault(sender, [])
+            new, pos = read_varint(payload, 0)
+            for _ in range(new):
+                length, pos = read_varint(payload, pos)
+                word_id = table.intern(str(payload[pos:pos + length], 'utf-8'))
+                count, pos = read_varint(payload, pos + length)
+                ids.append(word_id)
+                counts[word_id] += count
+            end = len(payload)
+            while pos < end:
+                sender_id, pos = read_varint(payload, pos)
+                count = payload[pos]
+                if count < 0x80:
+                    # Most batch counts fit in one byte
+                    pos += 1
+                else:
+                    count, pos = read_varint(payload, pos)
+                counts[ids[sender_id]] += count
+            print(f"Server {id} received {new} new words from server {sender}")
+
+        elif frame_type == FRAME_SHUFFLE or frame_type == FRAME_SHUFFLEC:
+            words = len(self.word_count_list)
+            merge_counts(self.word_count_list, decode_words(payload, 0, frame_type == FRAME_SHUFFLEC), job_combine())
+            print(f"Server {id} received {len(self.word_count_list) - words} new words")
+            self.word_count_runs.maybe_spill(self.word_count_list, len(self.word_count_list))
+
+        elif frame_type == FRAME_SHUFFLE2:
+            count, pos = read_varint(payload, 0)
+            words = self.count_word_list.setdefault(count, [])
+            received = len(words)
+            for word, _ in decode_words(payload, pos, False):
+                words.append(word)
+            self.hold_count_words(len(words) - received)
+
+        elif frame_type == FRAME_FINISH:
+            self.sender_ids.pop(sender, None)
+            return False
+        return True
+
+    def count_received(self, peer, n):
+        self.bytes_received[peer] = self.bytes_received.get(peer, 0) + n
+
+    def hold_count_words(self, n):
+        self.count_word_held += n
+        if self.count_word_runs.maybe_spill(self.count_word_list, self.count_word_held):
+            self.count_word_held = 0
+
+
+class Listener(threading.Thread, ShuffleReceiver):
+    def __init__(self, listener, peer):
+        threading.Thread.__init__(self)
+        ShuffleReceiver.__init__(self)
+        self.listener = listener  # ServerSocket
+        self.peer = peer  # server_id of the sender
+
     def closeThread(self):
         try:
             # Force accept() to unblock by connecting to our own listening socket
@@ -380,37 +1407,536 @@ class Listener(threading.Thread):
     def run(self):
         try:
             conn, addr = self.listener.accept()
-            with conn, conn.makefile('r') as f_in:
-                while True:
-                    line = f_in.readline()
-                    if not line:
-                        break
-                    tokens = line.strip().split(';')
-                    if tokens[0] == "SHUFFLE":
-                        for token in tokens[1:]:
-                            self.word_count_list.setdefault(token, []).append(1)
-                        print(f"Server {id} received {len(tokens)-1} words")
-                    
-                    elif tokens[0] == "SHUFFLE2":
-                        count = int(tokens[1])
-                        self.count_word_list.setdefault(count,[]).extend(tokens[2:])
-
-                    elif tokens[0] == "FINISH":
-                        break
+            with conn:
+                if wire_protocol == "binary":
+                    self.read_frames(conn)
+                else:
+                    self.read_lines(conn)
 
         except Exception as e:
             print(f"ERROR: server {id} in run Listener class error: {e}")
         finally:
             self.listener.close()
+            # A failed connection must not leave wait_round() blocked
+            self.round_finished.set()
+
+    def read_lines(self, conn):
+        # With a persistent mesh FINISH only ends the round, not the connection
+        with conn.makefile('r') as f_in:
+            for line in f_in:
+                self.count_received(self.peer, len(line))
+                if not self.handle_line(line):
+                    self.round_finished.set()
+                    if not persistent_mesh:
+                        break
+        self.round_finished.set()
+
+    def read_frames(self, conn):
+        reader = FrameReader(conn)
+        while True:
+            frame_type, payload = reader.read_frame()
+            if frame_type is None:
+                break
+            self.count_received(self.peer, FRAME_HEADER.size + len(payload))
+            if not self.handle_frame(frame_type, payload, self.peer):
+                self.round_finished.set()
+                if not persistent_mesh:
+                    break
+        self.round_finished.set()
+
+
+class ShuffleServer(threading.Thread, ShuffleReceiver):
+    # Single port alternative to one Listener per peer: one thread multiplexes
+    # every inbound peer connection with selectors and merges all of them into
+    # shared accumulators. Each peer first identifies itself with a HELLO.
+    def __init__(self, listener, peers_num):
+        threading.Thread.__init__(self)
+        ShuffleReceiver.__init__(self)
+        self.listener = listener  # ServerSocket
+        self.peers_num = peers_num  # peers sending a FINISH every round
+        self.finished = 0  # peers done with the current round
+        self.closed = 0  # peers that closed their connection
+        self.running = True
+        self.selector = selectors.DefaultSelector()
+
+    def closeThread(self):
+        self.running = False
+        self.listener.close()
+
+    def run(self):
+        try:
+            self.listener.setblocking(False)
+            self.selector.register(self.listener, selectors.EVENT_READ)
+            while self.running:
+                for key, _ in self.selector.select(select_timeout):
+                    if key.fileobj is self.listener:
+                        conn, addr = self.listener.accept()
+                        conn.setblocking(False)
+                        self.selector.register(conn, selectors.EVENT_READ, PeerConnection())
+                    elif not self.receive(key.fileobj, key.data):
+                        self.selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        self.closed += 1
+                        if not persistent_mesh and not key.data.finished:
+                            self.peer_finished(key.data)
+
+                if persistent_mesh:
+                    if self.closed == self.peers_num:
+                        break
+                elif self.round_finished.is_set():
+                    break
+        except Exception as e:
+            print(f"ERROR: server {id} in run ShuffleServer class error: {e}")
+        finally:
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+            self.listener.close()
+            self.round_finished.set()
+
+    def peer_finished(self, peer):
+        peer.finished = True
+        self.finished += 1
+        if self.finished == self.peers_num:
+            self.round_finished.set()
+            # The next round starts only once every server synchronized
+            self.finished = 0
+            for key in self.selector.get_map().values():
+                if key.data is not None:
+                    key.data.finished = False
+
+    def receive(self, conn, peer):
+        # Handles the complete messages received on conn, returns False once the peer closed it
+        data = conn.recv(recv_size)
+        if not data:
+            return False
+        peer.buffer += data
+        peer.received += len(data)
+        while True:
+            if wire_protocol == "binary":
+                frame_type, payload = peer.next_frame()
+                if frame_type is None:
+                    break
+                if frame_type == FRAME_HELLO:
+                    peer.sender, _ = read_varint(payload, 0)
+                    self.count_received(peer.sender, peer.received)
+                    peer.received = 0
+                    continue
+                done = not self.handle_frame(frame_type, payload, peer.sender)
+            else:
+                line = peer.next_line()
+                if line is None:
+                    break
+                if line.startswith("HELLO;"):
+                    peer.sender = int(line.strip().split(';')[1])
+                    self.count_received(peer.sender, peer.received)
+                    peer.received = 0
+                    continue
+                done = not self.handle_line(line)
+            if done:
+                self.peer_finished(peer)
+        if peer.sender is not None:
+            self.count_received(peer.sender, peer.received)
+            peer.received = 0
+        peer.compact()
+        return True
+
+
+class PeerConnection:
+    # Receive buffer of one inbound connection of the ShuffleServer
+    def __init__(self):
+        self.sender = None  # id of the peer, known after its HELLO
+        self.finished = False  # FINISH received for the current round
+        self.buffer = bytearray()
+        self.pos = 0  # start of the first unhandled message
+        self.scanned = 0  # bytes already searched for a newline
+        self.received = 0  # bytes not counted in bytes_received yet
+
+    def next_frame(self):
+        # Returns (frame_type, payload) of the next complete frame, or (None, None)
+        if len(self.buffer) - self.pos < FRAME_HEADER.size:
+            return None, None
+        length, frame_type, codec = FRAME_HEADER.unpack_from(self.buffer, self.pos)
+        start = self.pos + FRAME_HEADER.size
+        if len(self.buffer) - start < length:
+            return None, None
+        payload = bytes(self.buffer[start:start + length])
+        self.pos = start + length
+        if codec != CODEC_NONE:
+            payload = decompressors[codec](payload)
+        return frame_type, payload
+
+    def next_line(self):
+        # Returns the next complete text line, or None
+        nl = self.buffer.find(b'\n', max(self.pos, self.scanned))
+        if nl == -1:
+            self.scanned = len(self.buffer)
+            return None
+        line = self.buffer[self.pos:nl].decode('utf-8')
+        self.pos = nl + 1
+        return line
+
+    def compact(self):
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.scanned = max(0, self.scanned - self.pos)
+            self.pos = 0
+
+
+# ======= Binary wire protocol =======
+# Every frame is a FRAME_HEADER (payload length, frame type, codec) followed by
+# the payload. Words are encoded as a varint byte length and their utf-8 bytes,
+# FRAME_SHUFFLEC follows each word with a varint count and FRAME_SHUFFLE2
+# payloads start with the varint count shared by all their words. FRAME_SHUFFLEI
+# payloads start with a varint number of new words, encoded like FRAME_SHUFFLEC,
+# followed by varint (ID, count) pairs of the words the sender already sent this
+# round, the ID of a word being its rank among them.
+FRAME_HEADER = struct.Struct('>IBB')
+FRAME_SHUFFLE, FRAME_SHUFFLEC, FRAME_SHUFFLE2, FRAME_FINISH, FRAME_HELLO, FRAME_SHUFFLEI = 1, 2, 3, 4, 5, 6
+CODEC_NONE, CODEC_ZLIB, CODEC_LZMA = 0, 1, 2
+
+codecs = {
+    "zlib": (CODEC_ZLIB, lambda payload: zlib.compress(payload, compression_level)),
+    "lzma": (CODEC_LZMA, lambda payload: lzma.compress(payload, preset=compression_level)),
+}
+decompressors = {
+    CODEC_ZLIB: zlib.decompress,
+    CODEC_LZMA: lzma.decompress,
+}
+
+
+def write_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def read_varint(data, pos):
+    n, shift = 0, 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+class PeerWriter:
+    # Buffered binary output to one peer that counts the bytes it sends. Text
+    # protocol lines are accepted as str and sent utf-8 encoded.
+    def __init__(self, sock, peer):
+        self.output = sock.makefile('wb')
+        self.peer = peer
+        self.bytes_raw = 0  # bytes before compression
+        self.bytes_wire = 0  # bytes actually sent
+        self.codec = frame_compression
+        self.sampled_frames = 0
+        self.sampled_saved = 0  # bytes saved by compression on the sampled frames
+        self.sampled_time = 0.0  # seconds spent compressing the sampled frames
+        self.word_ids = {}  # {word: ID} sent in FRAME_SHUFFLEI frames this round
+
+    def reset_stats(self):
+        self.bytes_raw = 0
+        self.bytes_wire = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.output.write(data)
+        self.bytes_raw += len(data)
+        self.bytes_wire += len(data)
+
+    def write_frame(self, frame_type, payload):
+        raw_size = len(payload)
+        codec = CODEC_NONE
+        name = adaptive_codec if self.codec == "adaptive" else self.codec
+        if name and payload:
+            codec_id, compress = codecs[name]
+            t = time.perf_counter()
+            compressed = compress(payload)
+            if self.codec == "adaptive":
+                self.sample(raw_size - len(compressed), time.perf_counter() - t)
+            if len(compressed) < raw_size:
+                payload, codec = compressed, codec_id
+        self.output.write(FRAME_HEADER.pack(len(payload), frame_type, codec))
+        self.output.write(payload)
+        self.bytes_raw += FRAME_HEADER.size + raw_size
+        self.bytes_wire += FRAME_HEADER.size + len(payload)
+
+    def sample(self, saved, elapsed):
+        # Keeps compressing only if the transfer time saved exceeds the compression time
+        self.sampled_frames += 1
+        self.sampled_saved += saved
+        self.sampled_time += elapsed
+        if self.sampled_frames >= adaptive_sample_frames:
+            saved_time = self.sampled_saved / (link_bandwidth_mbps * 1000000 / 8)
+            self.codec = adaptive_codec if saved_time > self.sampled_time else None
+            print(f"Server {id} compression to server {self.peer}: {self.codec} "
+                  f"(saves {saved_time * 1000:.1f} ms, costs {self.sampled_time * 1000:.1f} ms)")
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        self.output.close()
+
+
+def peer_stats():
+    # "peer,raw_bytes,wire_bytes;..." for the current peer_outputs
+    return ";".join(f"{w.peer},{w.bytes_raw},{w.bytes_wire}" for w in peer_outputs if w is not None)
+
+
+def write_word_frames(output, frame_type, items, prefix=b""):
+    # items are words, or (word, count) pairs for FRAME_SHUFFLEC. Every frame
+    # starts with prefix and is sent once its payload reaches frame_size bytes.
+    with_counts = frame_type == FRAME_SHUFFLEC
+    payload = bytearray(prefix)
+    for item in items:
+        if with_counts:
+            word, count = item
+        else:
+            word = item
+        data = word.encode()
+        write_varint(payload, len(data))
+        payload += data
+        if with_counts:
+            write_varint(payload, count)
+        if len(payload) >= frame_size:
+            output.write_frame(frame_type, payload)
+            payload = bytearray(prefix)
+    if len(payload) > len(prefix):
+        output.write_frame(frame_type, payload)
+
+
+def write_interned_frames(output, items):
+    # FRAME_SHUFFLEI frames of (word, count) pairs, a word already sent to this peer
+    # during the round only costs its ID
+    word_ids = output.word_ids
+    new, new_words, known = 0, bytearray(), bytearray()
+    for word, count in items:
+        word_id = word_ids.get(word)
+        if word_id is None:
+            word_ids[word] = len(word_ids)
+            data = word.encode()
+            write_varint(new_words, len(data))
+            new_words += data
+            write_varint(new_words, count)
+            new += 1
+        else:
+            write_varint(known, word_id)
+            write_varint(known, count)
+        if len(new_words) + len(known) >= frame_size:
+            payload = bytearray()
+            write_varint(payload, new)
+            output.write_frame(FRAME_SHUFFLEI, payload + new_words + known)
+            new, new_words, known = 0, bytearray(), bytearray()
+    if new_words or known:
+        payload = bytearray()
+        write_varint(payload, new)
+        output.write_frame(FRAME_SHUFFLEI, payload + new_words + known)
+
+
+def decode_words(payload, pos, with_counts):
+    # Yields (word, count) pairs, count is 1 for frames without counts
+    end = len(payload)
+    count = 1
+    while pos < end:
+        length, pos = read_varint(payload, pos)
+        word = str(payload[pos:pos + length], 'utf-8')
+        pos += length
+        if with_counts:
+            count, pos = read_varint(payload, pos)
+        yield word, count
+
+
+class FrameReader:
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = bytearray(frame_size + FRAME_HEADER.size)  # reused for every frame
+
+    def read_exact(self, n):
+        # Returns a view of the next n bytes in the reusable buffer, or None at end of stream
+        if len(self.buffer) < n:
+            self.buffer = bytearray(n)
+        view = memoryview(self.buffer)[:n]
+        received = 0
+        while received < n:
+            r = self.conn.recv_into(view[received:], n - received)
+            if r == 0:
+                return None
+            received += r
+        return view
+
+    def read_frame(self):
+        # Returns (frame_type, payload), or (None, None) when the peer closed the connection
+        header = self.read_exact(FRAME_HEADER.size)
+        if header is None:
+            return None, None
+        length, frame_type, codec = FRAME_HEADER.unpack(header)
+        payload = self.read_exact(length) if length else memoryview(b"")
+        if payload is None:
+            return None, None
+        if codec != CODEC_NONE:
+            payload = decompressors[codec](payload)
+        return frame_type, payload
+
+phases = {
+    "SPLIT": split,
+    "SPLIT_SHUFFLE": split_shuffle,
+    "SHUFFLE": shuffle,
+    "SYNCHRONIZE": synchronize,
+    "GROUP": group,
+    "REDUCE": reduce,
+    "SHUFFLE2": shuffle2,
+    "SYNCHRONIZE2": synchronize2,
+    "GROUP2": group2,
+}
+
+
+class PhaseMetrics:
+    # Measurements of one phase, sent to the controller with its *_OK response
+    def __init__(self, phase):
+        self.phase = phase
+        self.values = {} # counters added by the phase, see add_metric()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.children_cpu = children_cpu_time()
+        self.profiler = None
+        if profile_phases:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    def finish(self):
+        result = {
+            "phase": self.phase,
+            "wall_ms": round((time.perf_counter() - self.wall) * 1000, 1),
+            "cpu_ms": round((time.process_time() - self.cpu) * 1000, 1),
+            # SPLIT workers are child processes
+            "children_cpu_ms": round((children_cpu_time() - self.children_cpu) * 1000, 1),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "words_per_server": sum(len(words) for words in words_per_server.values()),
+            "word_count_list": len(word_count_list),
+            "count_word_list": sum(len(words) for words in count_word_list.values()),
+            "final_count_word_list": sum(len(words) for words in final_count_word_list.values()),
+        }
+        if self.phase in ("SPLIT_SHUFFLE", "SHUFFLE", "SHUFFLE2") and peer_outputs:
+            result["bytes_sent"] = {w.peer: w.bytes_wire for w in peer_outputs if w is not None}
+        if self.phase in ("SYNCHRONIZE", "SYNCHRONIZE2") and thread_listeners:
+            received = {}
+            for thread in thread_listeners:
+                if thread is not None:
+                    for peer, n in thread.bytes_received.items():
+                        received[peer] = received.get(peer, 0) + n
+                    thread.bytes_received = {}
+            result["bytes_received"] = received
+        if trace_memory:
+            result["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        if self.profiler:
+            self.profiler.disable()
+            os.makedirs(profile_folder, exist_ok=True)
+            self.profiler.dump_stats(os.path.join(profile_folder, f"server{id}_{self.phase}.prof"))
+        result.update(self.values)
+        return result
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def start_phase(phase):
+    global metrics
+    metrics = PhaseMetrics(phase) if send_metrics else None
+
+
+def add_metric(key, n):
+    if metrics:
+        metrics.values[key] = metrics.values.get(key, 0) + n
+
+
+def count_tokens(partial):
+    # Tokens behind a split_range() result, summed from the combined counts
+    if use_combiner:
+        return sum(sum(words.values()) for words in partial.values())
+    return sum(len(words) for words in partial.values())
+
+
+def ok_line(response):
+    # "<PHASE>_OK[;...]" line ending the running phase, with its metrics after a tab
+    if not metrics:
+        return response + "\n"
+    return f"{response}\t{json.dumps(metrics.finish(), separators=(',', ':'))}\n"
+
+
+def parse_address(address):
+    # "host" or "host:port", the port defaults to server_port
+    host, _, port = address.partition(":")
+    return host, int(port) if port else server_port
+
+
+class ControllerOutput:
+    # Controller connection shared by the phases and the heartbeat thread, every
+    # write is a whole line so heartbeats only land between two lines
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def heartbeat():
+    # Tells the controller this server is alive while a phase runs, and notices
+    # when the controller dropped the job while the main thread is busy
+    while not quitting:
+        time.sleep(heartbeat_interval)
+        try:
+            with out.lock:
+                # Read under the lock so no PROGRESS line follows the SPLIT_OK
+                progress = split_progress
+                out.file.write(f"PROGRESS;{progress[0]};{progress[1]}\n" if progress else "HEARTBEAT\n")
+                out.file.flush()
+        except (OSError, ValueError) as e:
+            if not quitting:
+                print(f"Server {id} lost the controller: {e}")
+                restart()
+            return
+
+
+def restart():
+    # The controller re-executes the job on the surviving servers after a failure,
+    # a fresh process drops the state, threads and peer connections of the attempt
+    if not restart_on_abort:
+        return
+    print(f"Server {id} restarting for the next attempt.")
+    sys.stdout.flush()
+    argv = sys.argv if "--restarted" in sys.argv else sys.argv + ["--restarted"]
+    os.execv(sys.executable, [sys.executable] + argv)
+
 
 def main():
-    global server_socket, inp, out, id, servers_num
+    global server_socket, inp, out, id, servers_num, owners, job_module, job, use_combiner, intern_words, word_count_list, speculation, persistent_mesh
 
     # Start socket server
     try:
         listerner = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         listerner.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listerner.bind(('', server_port))
+        listerner.bind((bind_address, server_port))
         listerner.listen(1)
         print(f"ServerSocket listener on port: {server_port}")
     except OSError as e:
@@ -418,11 +1944,20 @@ def main():
         sys.exit(1)
 
     try:
-        server_socket, addr = listerner.accept()
+        if restarted:
+            # No controller comes back once it aborted the job or dropped this server
+            listerner.settimeout(restart_timeout)
+        try:
+            server_socket, addr = listerner.accept()
+        except socket.timeout:
+            print(f"No controller connected within {restart_timeout} s of the restart, exiting.")
+            return
         print("ServerSocket accepted a client!")
+        # A controller retrying after a failure must wait for the restarted process
+        listerner.close()
 
         inp = server_socket.makefile('r')
-        out = server_socket.makefile('w')
+        out = ControllerOutput(server_socket.makefile('w'))
 
         first = True
 
@@ -439,12 +1974,44 @@ def main():
                     parts = t.strip().split()
                     if len(parts) < 2:
                         continue
+                    if parts[0] == "job":
+                        job_module = parts[1]
+                        continue
+                    if parts[0] == "owners":
+                        owners = [int(owner) for owner in parts[1].split(',')]
+                        continue
+                    if parts[0] == "pipeline":
+                        # A peer may shuffle while this server still splits, only a
+                        # mesh opened before the first phase is listening by then
+                        if parts[1] == "1" and not persistent_mesh:
+                            print(f"Server {id} forces persistent_mesh in pipeline mode")
+                            persistent_mesh = True
+                        continue
+                    if parts[0] == "speculation":
+                        speculation = parts[1] == "1"
+                        continue
                     idx, addr = int(parts[0]), parts[1]
-                    servers[idx] = addr
+                    servers[idx], server_ports[idx] = parse_address(addr)
                     if len(parts) > 2 and parts[2] == "1":
                         id = idx
                 servers_num = len(servers)
+                if not owners:
+                    owners = list(range(servers_num))
                 first = False
+                threading.Thread(target=heartbeat, daemon=True).start()
+                if job_module:
+                    # Jobs always emit combined {key: value} partitions
+                    job = load_job(job_module)
+                    use_combiner = True
+                init_spill_runs()
+                if intern_words and (not use_combiner or wire_protocol != "binary" or memory_budget_words or job_combine()):
+                    # IDs are only sent in binary frames of summed counts held in memory
+                    print(f"Server {id} ignores intern_words with this configuration")
+                    intern_words = False
+                if intern_words:
+                    word_count_list = WordTable()
+                if persistent_mesh:
+                    open_peer_connections()
                 continue
 
             line = inp.readline()
@@ -453,23 +2020,25 @@ def main():
             line = line.strip()
 
             # Dispatch received command to functions
-            if line == "SPLIT":
-                split()
-            elif line == "SHUFFLE":
-                shuffle()
-            elif line == "SYNCHRONIZE":
-                synchronize()
-            elif line == "GROUP":
-                group()
-            elif line == "REDUCE":
-                reduce()
-            elif line == "SHUFFLE2":
-                shuffle2()
-            elif line == "SYNCHRONIZE2":
-                synchronize2()
-            elif line == "GROUP2":
-                group2()
+            if line in phases:
+                start_phase(line)
+                phases[line]()
+            elif line.startswith("PIPELINE;"):
+                # Runs the phases back to back, each one still reports its own *_OK
+                for phase in line.split(';')[1].split(','):
+                    start_phase(phase)
+                    phases[phase]()
+            elif line == "MERGE":
+                start_phase("MERGE")
+                sorted_output()
+            elif line.startswith("TOPK;"):
+                start_phase("TOPK")
+                sorted_output(int(line.split(';')[1]))
+            elif line.startswith("SPECULATE;"):
+                _, server, first_unit = line.split(';')
+                speculate(int(server), int(first_unit))
             elif line == "QUIT":
+                start_phase("QUIT")
                 quit()
                 break
 
@@ -481,5 +2050,30 @@ def main():
         if server_socket: server_socket.close()
         if listerner: listerner.close()
 
+    if not quitting:
+        restart()
+
 if __name__ == "__main__":
+    # Several servers can share a machine with distinct ports, datasets and results
+    parser = argparse.ArgumentParser(description="MapReduce server")
+    parser.add_argument("--port", type=int, default=server_port,
+                        help="port the controller connects to, the shuffle listeners use the next ones")
+    parser.add_argument("--bind", default=bind_address, help="address to listen on (default: every interface)")
+    parser.add_argument("--dataset", default=dataset_directory, help="folder of the input files")
+    parser.add_argument("--results", default=results_file, help="file the counts are saved to with save_results")
+    parser.add_argument("--split-workers", type=int, default=split_workers,
+                        help="local SPLIT processes, lower it when several servers share a machine")
+    parser.add_argument("--wire-protocol", choices=("binary", "text"), default=wire_protocol,
+                        help="peer shuffle traffic format")
+    parser.add_argument("--no-combiner", action="store_true", help="sends every word occurrence in SHUFFLE")
+    parser.add_argument("--restarted", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    server_port = args.port
+    bind_address = args.bind
+    dataset_directory = args.dataset
+    results_file = args.results
+    split_workers = max(1, args.split_workers)
+    wire_protocol = args.wire_protocol
+    use_combiner = use_combiner and not args.no_combiner
+    restarted = args.restarted
     main()
\ No newline at end of file
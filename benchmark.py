@@ -0,0 +1,242 @@
+import io
+import os
+import sys
+import time
+import random
+import resource
+import multiprocessing
+import contextlib
+from collections import Counter
+
+import Server
+
+# --------- CONFIG ---------
+dataset_file = "dataset/dummy_data.wet"  # bundled dataset
+bench_folder = "bench_data"  # folder for generated synthetic files
+synthetic_size_mb = 200  # size of the generated synthetic WET file
+vocab_size = 200000  # number of distinct words in the synthetic file
+partition_tokens = 2000000  # number of tokens hashed by the partitioner benchmark
+reader_size_mb = 2048  # size of the generated file read by the reader benchmark
+zipf_s = 1.1  # Zipf exponent of the synthetic word frequencies
+reduce_words = 3000000  # distinct words reduced by the REDUCE benchmark
+
+
+def generate_wet(file_path, size_mb, vocab_size=vocab_size, s=zipf_s, seed=0):
+    # Writes a WET-like text file of about size_mb MB with Zipf distributed words.
+    # An existing file is reused if it has that size, it overshoots by less than a chunk.
+    target = size_mb * 1024 * 1024
+    if os.path.isfile(file_path) and target <= os.path.getsize(file_path) < target + 1024 * 1024:
+        return file_path
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+
+    rng = random.Random(seed)
+    vocab = [f"word{i}" for i in range(vocab_size)]
+    cum_weights, total = [], 0.0
+    for rank in range(1, vocab_size + 1):
+        total += 1.0 / rank ** s
+        cum_weights.append(total)
+
+    written = 0
+    with open(file_path, "w", encoding="utf-8") as f:
+        while written < target:
+            lines = []
+            for _ in range(1000):
+                lines.append(" ".join(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(1, 20))))
+            chunk = "\n".join(lines) + "\n"
+            f.write(chunk)
+            written += len(chunk)
+    return file_path
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def isolated_target(queue, func, args):
+    queue.put(func(*args))
+
+
+def run_isolated(func, *args):
+    # Runs func in a fresh process so that its peak RSS is not polluted by other runs
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=isolated_target, args=(queue, func, args))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+# --------- MEMORY: count lists vs integer accumulators ---------
+def count_with_lists(file_path):
+    start = time.time()
+    word_count_list = {}  # {word: [counts]}
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            for token in line.strip().split():
+                word_count_list.setdefault(token, []).append(1)
+    totals = {word: sum(counts) for word, counts in word_count_list.items()}
+    return len(totals), peak_rss_mb(), (time.time() - start) * 1000
+
+
+def count_with_ints(file_path):
+    start = time.time()
+    word_count_list = {}  # {word: count}
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            for token in line.strip().split():
+                word_count_list[token] = word_count_list.get(token, 0) + 1
+    return len(word_count_list), peak_rss_mb(), (time.time() - start) * 1000
+
+
+def bench_memory():
+    files = [dataset_file, generate_wet(os.path.join(bench_folder, "synthetic.wet"), synthetic_size_mb)]
+    for file_path in files:
+        size_mb = os.path.getsize(file_path) / (1024 * 1024)
+        print(f"File: {file_path} ({size_mb:.1f} MB)")
+        for name, func in (("lists", count_with_lists), ("ints", count_with_ints)):
+            words, rss, elapsed = run_isolated(func, file_path)
+            print(f"  {name:5}: {words} words, peak RSS {rss:.1f} MB, {int(elapsed)} ms")
+
+
+# --------- PARTITIONERS: tokens/sec of each word -> server_id hash ---------
+def read_tokens(file_path, limit):
+    tokens = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            tokens.extend(line.split())
+            if len(tokens) >= limit:
+                break
+    return tokens[:limit]
+
+
+def partition_tokens_rate(partition_hash, tokens, servers_num, cache_size):
+    start = time.perf_counter()
+    partition_cache = {}
+    for token in tokens:
+        server_id = partition_cache.get(token)
+        if server_id is None:
+            server_id = partition_hash(token) % servers_num
+            if len(partition_cache) < cache_size:
+                partition_cache[token] = server_id
+    return len(tokens) / (time.perf_counter() - start)
+
+
+def bench_partitioners():
+    file_path = generate_wet(os.path.join(bench_folder, "synthetic.wet"), synthetic_size_mb)
+    tokens = read_tokens(file_path, partition_tokens)
+    print(f"Hashing {len(tokens)} tokens ({len(set(tokens))} distinct) into 20 partitions")
+    for name, partition_hash in Server.partitioners.items():
+        for cache_size in (0, Server.partition_cache_size):
+            rate = partition_tokens_rate(partition_hash, tokens, 20, cache_size)
+            memo = "memo" if cache_size else "no memo"
+            print(f"  {name:8} {memo:8}: {rate / 1e6:.2f} M tokens/s")
+
+
+# --------- READERS: MB/s of the line reader vs the mmap bytes reader ---------
+def bench_readers():
+    file_path = generate_wet(os.path.join(bench_folder, "reader.wet"), reader_size_mb)
+    size = os.path.getsize(file_path)
+    task = ([(file_path, 0, size)], list(range(20)), Server.partitioner, True, Server.partition_cache_size, None)
+    print(f"Reading {size / (1024 * 1024):.0f} MB with one process")
+    for name, split_func in (("lines", Server.split_range), ("mmap", Server.split_range_mmap)):
+        start = time.perf_counter()
+        partial = split_func(task)
+        elapsed = time.perf_counter() - start
+        words = sum(len(partition) for partition in partial.values())
+        print(f"  {name:5}: {size / (1024 * 1024) / elapsed:.1f} MB/s ({words} words)")
+
+
+# --------- INTERNING: receiver CPU of FRAME_SHUFFLEC vs FRAME_SHUFFLEI batches ---------
+class FrameRecorder:
+    # Stands in for a PeerWriter, keeps the frames instead of sending them
+    def __init__(self):
+        self.frames = []
+        self.word_ids = {}
+
+    def write_frame(self, frame_type, payload):
+        self.frames.append((frame_type, bytes(payload)))
+
+
+def bench_interning():
+    file_path = generate_wet(os.path.join(bench_folder, "synthetic.wet"), synthetic_size_mb)
+    tokens = read_tokens(file_path, partition_tokens)
+    batches = [Counter(tokens[i:i + Server.shuffle_batch_size]) for i in range(0, len(tokens), Server.shuffle_batch_size)]
+    print(f"Receiving {len(tokens)} tokens in {len(batches)} combined batches of {Server.shuffle_batch_size} tokens")
+    for name, intern in (("words", False), ("ids", True)):
+        output = FrameRecorder()
+        for batch in batches:
+            if intern:
+                Server.write_interned_frames(output, batch.items())
+            else:
+                Server.write_word_frames(output, Server.FRAME_SHUFFLEC, batch.items())
+        Server.intern_words = intern
+        receiver = Server.ShuffleReceiver()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for frame_type, payload in output.frames:
+                receiver.handle_frame(frame_type, payload, 1)
+        elapsed = time.perf_counter() - start
+        size = sum(len(payload) for _, payload in output.frames)
+        print(f"  {name:5}: {size / (1024 * 1024):.1f} MB, received in {int(elapsed * 1000)} ms "
+              f"({len(receiver.get_word_count_list())} words)")
+    Server.intern_words = False
+
+
+# --------- REDUCE: pure Python vs NumPy REDUCE and SHUFFLE2 routing ---------
+def bench_reduce():
+    file_path = generate_wet(os.path.join(bench_folder, "synthetic.wet"), synthetic_size_mb)
+    counts = Counter(read_tokens(file_path, partition_tokens))
+    # Extra distinct words with Zipf-like small counts, as in the tail of a real crawl
+    rng = random.Random(0)
+    for i in range(reduce_words - len(counts)):
+        counts[f"tail{i}"] = int(1 / rng.random() ** 0.5)
+    print(f"Reducing {len(counts)} distinct words into 20 SHUFFLE2 ranges")
+    if Server.np is None:
+        print("  NumPy is not installed, only the pure Python path runs")
+
+    Server.init_spill_runs()
+    step = max(counts.values()) // 20 + 1
+    Server.range_mins[:] = list(range(1, max(counts.values()) + 1, step))
+    Server.range_ids[:] = list(range(len(Server.range_mins)))
+    for name, use_numpy in (("python", False), ("numpy", True)):
+        if use_numpy and Server.np is None:
+            continue
+        Server.use_numpy = use_numpy
+        Server.word_count_list = dict(counts)
+        Server.count_word_list = {}
+        start = time.perf_counter()
+        if use_numpy:
+            result = Server.reduce_numpy()
+        else:
+            result = Server.reduce_python()
+        reduce_time = time.perf_counter() - start
+        start = time.perf_counter()
+        Server.route_counts(list(Server.count_word_list))
+        route_time = time.perf_counter() - start
+        print(f"  {name:6}: REDUCE {int(reduce_time * 1000)} ms, routing of {len(result[2])} counts "
+              f"{route_time * 1000:.1f} ms (max {result[0]}, min {result[1]})")
+    Server.use_numpy = True
+
+
+benchmarks = {
+    "memory": bench_memory,
+    "partitioners": bench_partitioners,
+    "readers": bench_readers,
+    "interning": bench_interning,
+    "reduce": bench_reduce,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            print(f"Unknown benchmark: {name} (available: {', '.join(benchmarks)})")
+            sys.exit(1)
+        print(f"--------- {name} ---------")
+        benchmarks[name]()
+
+
+if __name__ == "__main__":
+    main()
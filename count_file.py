@@ -0,0 +1,259 @@
+import os
+import sys
+import mmap
+import heapq
+import struct
+import shutil
+import argparse
+import tempfile
+from array import array
+
+# ======= Columnar word count files =======
+# A count file holds (word, count) entries sorted by decreasing count:
+#   HEADER      magic, entries, then the byte offset of every section below
+#   words       utf-8 bytes of all the words, back to back, padded to align the columns
+#   offsets     entries + 1 uint64, word i is words[offsets[i]:offsets[i + 1]]
+#   counts      entries uint64
+#   by_word     entries uint64 entry numbers sorted by word bytes, the index of get()
+# Integers are in the byte order of the machine that wrote the file.
+MAGIC = b"WCF1"
+HEADER = struct.Struct("=4sQQQQQ")
+index_run_entries = 500000  # Entries sorted in memory at once for the by_word index, more are merged from sorted runs
+
+
+def read_run(f):
+    # Yields the entry numbers of a sorted run file, a block at a time
+    f.seek(0)
+    while True:
+        block = array("Q")
+        try:
+            block.fromfile(f, 65536)
+        except EOFError:
+            pass
+        if not block:
+            return
+        yield from block
+
+
+class CountFileWriter:
+    # Streams (count, words) batches by decreasing count to path. Words go to disk as
+    # they come, the offsets and counts columns and the by_word index in sorted runs of
+    # index_run_entries entries to temporary files, so memory does not grow with the file.
+    # close() appends the columns and k-way merges the runs into the index.
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.file = open(self.tmp_path, "wb", buffering=1024 * 1024)
+        self.file.write(bytes(HEADER.size))
+        folder = os.path.dirname(path) or "."
+        self.offsets_file = tempfile.TemporaryFile(dir=folder)
+        self.counts_file = tempfile.TemporaryFile(dir=folder)
+        self.runs = []  # temporary files of entry numbers sorted by word bytes
+        self.offsets = array("Q", [0])  # offsets not written to offsets_file yet
+        self.counts = array("Q")  # counts not written to counts_file yet
+        self.run = []  # word bytes of the entries from run_start on, not sorted yet
+        self.run_start = 0
+        self.entries = 0
+        self.words_size = 0
+        self.last_count = None
+
+    def write(self, count, words):
+        if self.last_count is not None and count > self.last_count:
+            raise ValueError(f"count {count} after {self.last_count}, counts must be decreasing")
+        self.last_count = count
+        for word in words:
+            data = word.encode()
+            self.file.write(data)
+            self.words_size += len(data)
+            self.offsets.append(self.words_size)
+            self.counts.append(count)
+            self.run.append(data)
+            self.entries += 1
+            if len(self.run) >= index_run_entries:
+                self.spill()
+
+    def spill(self):
+        # Writes the pending column values and the pending entries as one sorted run
+        self.offsets.tofile(self.offsets_file)
+        self.counts.tofile(self.counts_file)
+        self.offsets, self.counts = array("Q"), array("Q")
+        if self.run:
+            run = self.run
+            order = array("Q", (self.run_start + k for k in sorted(range(len(run)), key=run.__getitem__)))
+            f = tempfile.TemporaryFile(dir=os.path.dirname(self.path) or ".")
+            order.tofile(f)
+            self.runs.append(f)
+            self.run_start = self.entries
+            self.run = []
+
+    def close(self):
+        # Writes the columns and the index, then moves the file to path
+        self.spill()
+        padding = -(HEADER.size + self.words_size) % 8
+        self.file.write(bytes(padding))
+        offsets_start = HEADER.size + self.words_size + padding
+        self.offsets_file.seek(0)
+        shutil.copyfileobj(self.offsets_file, self.file)
+        counts_start = offsets_start + (self.entries + 1) * 8
+        self.counts_file.seek(0)
+        shutil.copyfileobj(self.counts_file, self.file)
+        by_word_start = counts_start + self.entries * 8
+        self.file.flush()
+
+        if len(self.runs) == 1:
+            self.runs[0].seek(0)
+            shutil.copyfileobj(self.runs[0], self.file)
+        elif self.runs:
+            self.merge_runs(offsets_start, counts_start)
+
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, self.entries, HEADER.size, offsets_start, counts_start, by_word_start))
+        self.file.close()
+        self.close_temporary_files()
+        os.replace(self.tmp_path, self.path)
+
+    def merge_runs(self, offsets_start, counts_start):
+        # Appends the by_word index merged from the runs, words are compared in the
+        # words section of the file through an mmap
+        with open(self.tmp_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = memoryview(mm)[offsets_start:counts_start].cast("Q")
+            try:
+                base = HEADER.size
+                merged = heapq.merge(*map(read_run, self.runs), key=lambda i: mm[base + offsets[i]:base + offsets[i + 1]])
+                by_word = array("Q")
+                for i in merged:
+                    by_word.append(i)
+                    if len(by_word) >= index_run_entries:
+                        by_word.tofile(self.file)
+                        by_word = array("Q")
+                by_word.tofile(self.file)
+            finally:
+                offsets.release()
+
+    def close_temporary_files(self):
+        for f in [self.offsets_file, self.counts_file] + self.runs:
+            f.close()
+        self.runs = []
+
+    def abort(self):
+        self.file.close()
+        self.close_temporary_files()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CountFileReader:
+    # mmap view of a count file, only the pages of the entries looked at are read
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.entries, self.words_start, offsets_start, counts_start, by_word_start = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a count file")
+        view = memoryview(self.mm)
+        self.offsets = view[offsets_start:counts_start].cast("Q")
+        self.counts = view[counts_start:by_word_start].cast("Q")
+        self.by_word = view[by_word_start:by_word_start + self.entries * 8].cast("Q")
+
+    def __len__(self):
+        return self.entries
+
+    def word_bytes(self, i):
+        return self.mm[self.words_start + self.offsets[i]:self.words_start + self.offsets[i + 1]]
+
+    def word(self, i):
+        return self.word_bytes(i).decode()
+
+    def get(self, word):
+        # Count of word, None if it is not in the file. Binary search over by_word.
+        data = word.encode()
+        lo, hi = 0, self.entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word_bytes(self.by_word[mid]) < data:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.entries and self.word_bytes(self.by_word[lo]) == data:
+            return self.counts[self.by_word[lo]]
+        return None
+
+    def top(self, n):
+        return [(self.word(i), self.counts[i]) for i in range(min(n, self.entries))]
+
+    def items(self):
+        # Yields the (word, count) entries by decreasing count
+        for i in range(self.entries):
+            yield self.word(i), self.counts[i]
+
+    def close(self):
+        self.offsets.release()
+        self.counts.release()
+        self.by_word.release()
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def merge_count_files(output_path, paths):
+    # k-way merge of the count files of the servers into one. Every word is reduced
+    # on a single server, so the files hold disjoint words and are only interleaved.
+    readers = [CountFileReader(path) for path in paths]
+    try:
+        merged = heapq.merge(*(reader.items() for reader in readers), key=lambda item: -item[1])
+        with CountFileWriter(output_path) as writer:
+            for word, count in merged:
+                writer.write(count, [word])
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reads and merges the columnar word count files of the servers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    get = commands.add_parser("get", help="prints the count of words")
+    get.add_argument("file")
+    get.add_argument("words", nargs="+")
+    top = commands.add_parser("top", help="prints the n most frequent words")
+    top.add_argument("file")
+    top.add_argument("n", type=int)
+    dump = commands.add_parser("dump", help="prints every entry as \"count: word\"")
+    dump.add_argument("file")
+    merge = commands.add_parser("merge", help="merges the files of all servers into output")
+    merge.add_argument("output")
+    merge.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        merge_count_files(args.output, args.files)
+        with CountFileReader(args.output) as reader:
+            print(f"Merged {len(args.files)} files into {args.output} ({len(reader)} words)")
+        return
+    with CountFileReader(args.file) as reader:
+        if args.command == "get":
+            for word in args.words:
+                print(f"{word}\t{reader.get(word)}")
+        elif args.command == "top":
+            for word, count in reader.top(args.n):
+                print(f"{count}\t{word}")
+        else:
+            for word, count in reader.items():
+                sys.stdout.write(f"{count}: {word}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,53 @@
 import os
 import re
+import sys
+import json
 import matplotlib.pyplot as plt
 import pandas as pd
 
 # --------- CONFIG ---------
-logs_folder = "./results"  # your results folder path
+logs_folder = sys.argv[1] if len(sys.argv) > 1 else "./results"  # your results folder path, e.g. results/local
 save_folder = "./graphs"  # folder to save graphs
+metrics_folder = "./metrics"  # metrics{i}.json reports of Controller.py copied by run.sh
 
 phase_keys = [
-    "Time for SPLIT", "Time for SHUFFLE", "Time for SYNCHRONIZE",
+    "Time for SPLIT", "Time for SPLIT_SHUFFLE", "Time for SHUFFLE", "Time for SYNCHRONIZE",
     "Time for GROUP", "Time for REDUCE", "Time for RANGE",
     "Time for SHUFFLE2", "Time for SYNCHRONIZE2", "Time for GROUP2",
+    "Time for MERGE", "Time for TOPK",
     "Time for sending node info",
 ]
 summary_keys = [
     "Time for shuffle", "Time for computation", "Time for controller communication", "Time total",
 ]
 
+
+def metrics_totals(metrics):
+    # Sums the per-phase metrics report of Controller.py over the whole job
+    phases = [phase["total"] for phase in metrics["phases"]]
+    wall_ms = sum(total["max_wall_ms"] for total in phases)
+    return {
+        "Wall time": wall_ms,
+        "CPU time": sum(total["cpu_ms"] for total in phases),
+        "Peak RSS": max(total["max_peak_rss_mb"] for total in phases),
+    }
+
+
 # --------- EXTRACT DATA ---------
 data = []
-log_files = sorted(os.listdir(logs_folder), key=lambda x: int(re.search(r'\d+', x).group()))  # sort by number in filename
+log_files = sorted((f for f in os.listdir(logs_folder) if os.path.isfile(os.path.join(logs_folder, f))), key=lambda x: int(re.search(r'\d+', x).group()))  # sort by number in filename
 
 for idx, fname in enumerate(log_files):
     filepath = os.path.join(logs_folder, fname)
+    if fname.endswith(".json"):
+        # Written by local_cluster.py
+        with open(filepath) as f:
+            result = json.load(f)
+        times = {"Machines": result["servers"], **result["times_ms"]}
+        if result.get("metrics"):
+            times.update(metrics_totals(result["metrics"]))
+        data.append(times)
+        continue
     times = {"Machines": idx + 1}
     with open(filepath) as f:
         for line in f:
@@ -30,6 +55,10 @@ for idx, fname in enumerate(log_files):
             if match:
                 key, val = match.groups()
                 times[key.strip()] = int(val)
+    metrics_path = os.path.join(metrics_folder, f"metrics{idx + 1}.json")
+    if os.path.isfile(metrics_path):
+        with open(metrics_path) as f:
+            times.update(metrics_totals(json.load(f)))
     data.append(times)
 
 df = pd.DataFrame(data).set_index("Machines")
@@ -92,4 +121,30 @@ plt.tight_layout()
 plt.grid(True, axis='y')
 plt.savefig(f"{save_folder}/graph_summary_times_stacked.png")
 
-print("Graphs generated:\n - graph_total_time.png\n - graph_speedup.png\n - graph_phase_times_stacked.png\n - graph_summary_times_stacked.png")
+graphs = ["graph_total_time.png", "graph_speedup.png", "graph_phase_times_stacked.png", "graph_summary_times_stacked.png"]
+
+if "CPU time" in df.columns:
+    # --------- GRAPH 5: CPU efficiency, total CPU time over wall time times machines ---------
+    efficiency = df["CPU time"] / (df["Wall time"] * machines)
+    plt.figure()
+    plt.plot(machines, efficiency, marker='o', label="CPU time / (wall time x machines)")
+    plt.xticks(machines)
+    plt.xlabel("Number of Machines")
+    plt.ylabel("CPU Efficiency")
+    plt.title("CPU Efficiency vs Number of Machines")
+    plt.legend()
+    plt.grid(True)
+    plt.savefig(f"{save_folder}/graph_cpu_efficiency.png")
+
+    # --------- GRAPH 6: Peak RSS of the biggest server vs number of machines ---------
+    plt.figure()
+    plt.plot(machines, df["Peak RSS"], marker='o', label="Max peak RSS of a server")
+    plt.xticks(machines)
+    plt.xlabel("Number of Machines")
+    plt.ylabel("Peak RSS (MB)")
+    plt.title("Peak Server Memory vs Number of Machines")
+    plt.grid(True)
+    plt.savefig(f"{save_folder}/graph_peak_rss.png")
+    graphs += ["graph_cpu_efficiency.png", "graph_peak_rss.png"]
+
+print("Graphs generated:\n - " + "\n - ".join(graphs))
@@ -0,0 +1,23 @@
+from urllib.parse import urlsplit
+
+# Sums the Content-Length of the WET records of each domain, read from the
+# WARC-Target-URI and Content-Length headers of every record. Chunks start at
+# a record, so both headers of a record are always in the same chunk.
+
+record_start = b"WARC/1.0"
+
+
+def map_chunk(text):
+    totals = {}
+    domain = None
+    for line in text.splitlines():
+        if line.startswith("WARC-Target-URI:"):
+            domain = urlsplit(line.split(":", 1)[1].strip()).hostname
+        elif line.startswith("Content-Length:") and domain:
+            try:
+                length = int(line.split(":", 1)[1])
+            except ValueError:
+                continue
+            totals[domain] = totals.get(domain, 0) + length
+            domain = None
+    return totals
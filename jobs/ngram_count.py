@@ -0,0 +1,11 @@
+from collections import Counter
+
+# Counts word bigrams, without crossing line boundaries. Keys are "w1 w2".
+
+
+def map_chunk(text):
+    counts = Counter()
+    for line in text.splitlines():
+        words = line.split()
+        counts.update(" ".join(pair) for pair in zip(words, words[1:]))
+    return counts
@@ -0,0 +1,16 @@
+from collections import Counter
+
+# Reference job: the same result as the built-in word count, through the job API.
+# Server.py keeps its own specialized word count path when no job is set.
+
+
+def map_chunk(text):
+    return Counter(text.split())
+
+
+def combine(a, b):
+    return a + b
+
+
+def reduce(key, value):
+    return value
@@ -0,0 +1,214 @@
+import os
+import re
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+
+from benchmark import generate_wet
+
+# --------- CONFIG ---------
+run_folder = "bench_data/local"  # working folder of the local servers and controller
+results_folder = "results/local"  # JSON results, one file per number of servers
+server_counts = [1, 2, 4]  # numbers of local servers to run
+synthetic_size_mb = 200  # size of the generated synthetic WET file
+edge_words = ["a;b", ";", ";;", "x;y;z", "word1;", ";word2", "tab;\u00e9"]  # words the shuffle protocols must keep whole, added to the input with --check
+port_base = 9000  # server k listens on port_base + k * (servers + 1) and the next servers ports
+run_timeout = 600  # seconds before a run is considered stuck
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def server_ports(n):
+    # Each server needs its controller port plus one shuffle port per peer
+    return [port_base + k * (n + 1) for k in range(n)]
+
+
+def parse_times(lines):
+    # Same "<key>: <value> ms" lines as draw_graphs.py reads from results/*.txt
+    times = {}
+    for line in lines:
+        match = re.match(r"(.+?):\s+(\d+)\s+ms", line.strip())
+        if match:
+            key, val = match.groups()
+            times[key.strip()] = int(val)
+    return times
+
+
+def wait_listening(n, timeout=30):
+    # Connecting to check would take the place of the controller, read the logs instead
+    deadline = time.time() + timeout
+    for k in range(n):
+        path = os.path.join(run_folder, f"server{k}.log")
+        while True:
+            with open(path) as f:
+                if "ServerSocket listener on port" in f.read():
+                    break
+            if time.time() > deadline:
+                print(f"  server {k} is not listening after {timeout} s, see {path}")
+                return
+            time.sleep(0.05)
+
+
+def input_counts(dataset_folder):
+    # Tokens and distinct words of the input, split like the servers do
+    tokens, words = 0, set()
+    for fname in os.listdir(dataset_folder):
+        with open(os.path.join(dataset_folder, fname), "rb") as f:
+            for line in f:
+                line_words = line.decode("utf-8", errors="replace").split()
+                tokens += len(line_words)
+                words.update(line_words)
+    return tokens, len(words)
+
+
+def check_counts(result, dataset_folder):
+    # Compares the SPLIT tokens and the words grouped by the servers to the input,
+    # returns the list of mismatches
+    if not result["completed"]:
+        return ["the job did not complete"]
+    if not result["metrics"]:
+        return [f"no metrics report in {run_folder}"]
+    phases = {phase["phase"]: phase for phase in result["metrics"]["phases"]}
+    tokens, distinct = input_counts(dataset_folder)
+    counted = phases["SPLIT"]["total"]["tokens"]
+    grouped = sum(m["word_count_list"] for m in phases["GROUP"]["servers"])
+    errors = []
+    if counted != tokens:
+        errors.append(f"SPLIT counted {counted} tokens, the input has {tokens}")
+    if grouped != distinct:
+        errors.append(f"GROUP holds {grouped} words, the input has {distinct}")
+    if "GROUP2" in phases:
+        final = sum(m["final_count_word_list"] for m in phases["GROUP2"]["servers"])
+        if final != distinct:
+            errors.append(f"GROUP2 holds {final} words, the input has {distinct}")
+    return errors
+
+
+def write_edge_words(path):
+    # Each edge word k appears k + 1 times, so they go through SHUFFLE2 with distinct counts
+    with open(path, "w", encoding="utf-8") as f:
+        for k, word in enumerate(edge_words):
+            f.write(" ".join([word] * (k + 1)) + "\n")
+
+
+def run_local(n, size_mb, kill=None, server_args=(), check=False):
+    # Runs the whole job on n local servers and returns its JSON result. With kill,
+    # that server is SIGKILLed once SPLIT is done, i.e. during SHUFFLE. With check or
+    # kill, the edge words are added to the input and the counts checked.
+    dataset_folder = os.path.join(run_folder, "dataset")
+    generate_wet(os.path.join(dataset_folder, "synthetic.wet"), size_mb)
+    edge_path = os.path.join(dataset_folder, "edge_words.wet")
+    check = check or kill is not None
+    if check:
+        write_edge_words(edge_path)
+    elif os.path.exists(edge_path):
+        os.remove(edge_path)
+    input_bytes = sum(os.path.getsize(os.path.join(dataset_folder, f)) for f in os.listdir(dataset_folder))
+
+    killed = kill
+    metrics_path = os.path.join(run_folder, "metrics.json")
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    ports = server_ports(n)
+    with open(os.path.join(run_folder, "machines.txt"), "w") as f:
+        f.writelines(f"127.0.0.1:{p}\n" for p in ports)
+
+    servers = []
+    for k, p in enumerate(ports):
+        log = open(os.path.join(run_folder, f"server{k}.log"), "w")
+        servers.append(subprocess.Popen([sys.executable, "-u", os.path.join(here, "Server.py"), "--port", str(p), *server_args],
+                                        cwd=run_folder, stdout=log, stderr=subprocess.STDOUT))
+        log.close()
+    wait_listening(n)
+
+    start = time.time()
+    lines = []
+    controller = subprocess.Popen([sys.executable, "-u", os.path.join(here, "Controller.py")], cwd=run_folder,
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        for line in controller.stdout:
+            lines.append(line)
+            if kill is not None and line.startswith("Time for SPLIT:"):
+                servers[kill].send_signal(signal.SIGKILL)
+                print(f"  killed server {kill} during SHUFFLE")
+                kill = None
+            if time.time() - start > run_timeout:
+                break
+        controller.wait(timeout=max(1, run_timeout - (time.time() - start)))
+    finally:
+        controller.kill()
+        for server in servers:
+            try:
+                server.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    wall_time = time.time() - start
+
+    with open(os.path.join(run_folder, "controller.log"), "w") as f:
+        f.writelines(lines)
+
+    times = parse_times(lines)
+    total_ms = times.get("Time total")
+    metrics = None
+    if os.path.exists(metrics_path):
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+    return {
+        "servers": n,
+        "input_bytes": input_bytes,
+        "killed_server": killed,
+        "failures": sum(line.startswith("Re-executing") for line in lines),
+        "completed": any(line.startswith("All processes are done.") for line in lines),
+        "wall_time_s": round(wall_time, 3),
+        "throughput_mb_s": round(input_bytes / (1024 * 1024) / (total_ms / 1000), 2) if total_ms else None,
+        "times_ms": times,
+        "metrics": metrics,  # per-phase metrics report of Controller.py
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs Controller.py against N local Server.py processes")
+    parser.add_argument("--servers", default=",".join(map(str, server_counts)),
+                        help="comma separated numbers of servers to run (default %(default)s)")
+    parser.add_argument("--size-mb", type=int, default=synthetic_size_mb, help="synthetic input size")
+    parser.add_argument("--kill", type=int, default=None,
+                        help="server index to kill during SHUFFLE, the counts of the re-executed job are then checked")
+    parser.add_argument("--check", action="store_true",
+                        help="adds words holding ';' to the input and checks that every word is counted once")
+    parser.add_argument("--wire-protocol", choices=("binary", "text"), default="binary", help="peer shuffle traffic format")
+    parser.add_argument("--no-combiner", action="store_true", help="sends every word occurrence in SHUFFLE")
+    args = parser.parse_args()
+    server_args = ["--wire-protocol", args.wire_protocol] + (["--no-combiner"] if args.no_combiner else [])
+
+    os.makedirs(results_folder, exist_ok=True)
+    failed = False
+    for n in (int(x) for x in args.servers.split(",")):
+        print(f"--------- {n} local server(s), {args.size_mb} MB ---------")
+        kill = args.kill if args.kill is not None and args.kill < n else None
+        result = run_local(n, args.size_mb, kill, server_args, args.check)
+        if args.check or kill is not None:
+            errors = check_counts(result, os.path.join(run_folder, "dataset"))
+            if kill is not None and not result["failures"]:
+                errors.append("the controller did not re-execute the job")
+            result["check_errors"] = errors
+            for error in errors:
+                print(f"  CHECK FAILED: {error}")
+            if not errors:
+                killed = f"killed server {kill}, the re-executed job" if kill is not None else "the job"
+                print(f"  {killed} counted every word")
+            failed = failed or bool(errors)
+        path = os.path.join(results_folder, f"result{n}.json")
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"  total {result['times_ms'].get('Time total')} ms, {result['throughput_mb_s']} MB/s, saved to {path}")
+        if not result["completed"]:
+            print(f"  run did not complete, see {run_folder}/controller.log")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
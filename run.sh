@@ -9,8 +9,10 @@ local_server_script="Server.py"
 local_controller_script="Controller.py"
 remote_folder="~/Desktop/experiment"  # Shared folder
 dataset_file="/cal/commoncrawl/CC-MAIN-20230321002050-20230321032050-00486.warc.wet"  # dataset to copy to servers
+workers_per_machine=1  # Server.py processes per machine, each one on its own ports
+base_port=8000  # port of the first server of each machine
 
-mkdir -p results
+mkdir -p results metrics
 echo "tp-1a226-02" > machines.txt
 
 # ----------- DEPLOY SERVERS -----------
@@ -18,7 +20,8 @@ echo "[INFO] Deploying server scripts..."
 while read -r machine; do
     echo "[INFO] Setting up server on $machine"
     ssh "$login@$machine" "rm -rf $remote_folder; mkdir -p $remote_folder/dataset"
-    scp "$local_server_script" "$login@$machine:$remote_folder/"
+    scp "$local_server_script" count_file.py "$login@$machine:$remote_folder/"
+    scp -r jobs "$login@$machine:$remote_folder/"
 
     echo "[INFO] Copying initial dataset to $machine..."
     ssh "$login@$machine" "cp $dataset_file $remote_folder/dataset/"
@@ -27,7 +30,7 @@ done < machines.txt
 # ----------- DEPLOY CONTROLLER  -----------
 echo "[INFO] Deploying controller script to $controller_machine ..."
 ssh "$login@$controller_machine" "mkdir -p $remote_folder"  # just ensure the folder exists
-scp "$local_controller_script" "$login@$controller_machine:$remote_folder/"
+scp "$local_controller_script" count_file.py "$login@$controller_machine:$remote_folder/"
 scp machines.txt "$login@$controller_machine:$remote_folder/"
 
 # ---------- MAIN LOOP ----------
@@ -35,10 +38,13 @@ for ((i=1; i<=N; i++)); do
     echo "------------ Running iteration $i ------------"
 
     # ----------- WRITE MACHINES.TXT -----------
-    echo "[INFO] Writing machines.txt with $i machine(s)"
+    echo "[INFO] Writing machines.txt with $i machine(s), $workers_per_machine server(s) each"
     > machines.txt
+    stride=$((i * workers_per_machine + 1))  # a server uses its port plus one shuffle port per server
     for ((j=0; j<i; j++)); do
-        echo "tp-1a226-${computers[$j]}" >> machines.txt
+        for ((w=0; w<workers_per_machine; w++)); do
+            echo "tp-1a226-${computers[$j]}:$((base_port + w * stride))" >> machines.txt
+        done
     done
 
     # ----------- UPDATE CONTROLLER MACHINES.TXT -----------
@@ -46,11 +52,11 @@ for ((i=1; i<=N; i++)); do
 
     # ----------- START SERVERS -----------
     echo "[INFO] Starting servers..."
-    while read -r machine; do
-        ssh "-tt" "$login@$machine" "cd $remote_folder; python3 Server.py" &
+    while IFS=: read -r machine port; do
+        ssh "-tt" "$login@$machine" "cd $remote_folder; python3 Server.py --port $port --results word_count_$port.wcf --split-workers \$(( \$(nproc) / $workers_per_machine ))" &
     done < machines.txt
 
-    sleep 10  # give servers time to start
+    sleep 1  # the controller retries connecting to servers that are not listening yet
 
     # ----------- RUN controller -----------
     echo "[INFO] Running controller..."
@@ -58,7 +64,9 @@ for ((i=1; i<=N; i++)); do
 
     wait
 
-    echo "[INFO] Saved controller result to results/result$i.txt"
+    scp "$login@$controller_machine:$remote_folder/metrics.json" "metrics/metrics$i.json"
+
+    echo "[INFO] Saved controller result to results/result$i.txt and metrics to metrics/metrics$i.json"
 done
 
 echo "------------ Finished running all iterations ------------"